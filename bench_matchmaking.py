@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+assert __name__ == '__main__'
+
+# Matches per second at steady queue depth: job_server's old list-scanning matchmake vs
+# matchmaking.Matchmaker, without and with fair share across the jobs' 4 hosts.
+#
+# usage: bench_matchmaking.py [num_keys] [num_workers]
+
+import itertools
+import random
+import sys
+import time
+
+import matchmaking
+
+NUM_KEYS = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+NUM_WORKERS = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+DEPTHS = (100, 1000, 10000, 100000)
+MIN_SECS = 0.5
+
+# --
+
+class Job(object):
+    def __init__(self, id, key):
+        self.id = id
+        self.key = key
+        self.hostname = 'client{}'.format(id % 4)
+        self.priority = 0
+        self.cost = 0.0
+        self.exclude = ''
+
+
+class Worker(object):
+    def __init__(self, keys):
+        self.keys = keys
+        self.avail_slots = float(random.randint(1, 32))
+
+# -
+
+class ListMatchmaker(object):
+    def __init__(self):
+        self.job_queue_by_key = {}
+        self.available_workers_by_key = {}
+
+
+    def add_job(self, job):
+        job_queue = self.job_queue_by_key.setdefault(job.key, [])
+        job_queue.append(job)
+        job_queue.sort(key=lambda x: x.id)
+
+
+    def set_worker(self, worker, key, weight):
+        workers = self.available_workers_by_key.setdefault(key, [])
+        if weight:
+            if worker not in workers:
+                workers.append(worker)
+        else:
+            workers.remove(worker)
+            if not workers:
+                del self.available_workers_by_key[key]
+
+
+    def pop_match(self):
+        next_jobs = [x[0] for x in self.job_queue_by_key.values()]
+        next_jobs = sorted(next_jobs, key=lambda x: x.id)
+        for job in next_jobs:
+            try:
+                workers = self.available_workers_by_key[job.key]
+            except KeyError:
+                continue
+            weights = (x.avail_slots for x in workers)
+            cum_weights = list(itertools.accumulate(weights))
+            (worker,) = random.choices(workers, cum_weights=cum_weights, k=1)
+
+            job_queue = self.job_queue_by_key[job.key]
+            job_queue.remove(job)
+            if not job_queue:
+                del self.job_queue_by_key[job.key]
+            return (job, worker)
+        return (None, None)
+
+# -
+
+def bench(mm, depth, fair_share=None):
+    random.seed(depth)
+    next_id = itertools.count()
+    keys = list(range(NUM_KEYS))
+    workers = [Worker(random.sample(keys, min(2, NUM_KEYS))) for _ in range(NUM_WORKERS)]
+    for w in workers:
+        for k in w.keys:
+            mm.set_worker(w, k, w.avail_slots)
+    for _ in range(depth):
+        mm.add_job(Job(next(next_id), random.choice(keys)))
+
+    # Like job_server: a matched worker goes unavailable until it reports slots again.
+    matches = 0
+    t0 = time.perf_counter()
+    while True:
+        for _ in range(100):
+            (job, worker) = mm.pop_match()
+            assert job
+            if fair_share:
+                fair_share.on_assigned(job.hostname, job.key)
+            for k in worker.keys:
+                mm.set_worker(worker, k, 0.0)
+            for k in worker.keys:
+                mm.set_worker(worker, k, worker.avail_slots)
+            mm.add_job(Job(next(next_id), random.choice(keys)))
+        matches += 100
+        secs = time.perf_counter() - t0
+        if secs >= MIN_SECS:
+            return matches / secs
+
+# --
+
+print(f'{NUM_KEYS} keys, {NUM_WORKERS} workers')
+print(f'{"depth":>8} {"list (match/s)":>16} {"indexed (match/s)":>18} {"fair (match/s)":>16}')
+for depth in DEPTHS:
+    old = bench(ListMatchmaker(), depth)
+    new = bench(matchmaking.Matchmaker(), depth)
+    fair_share = matchmaking.FairShare(3600.0)
+    fair = bench(matchmaking.Matchmaker(fair_share=fair_share), depth, fair_share)
+    print(f'{depth:>8} {old:>16.0f} {new:>18.0f} {fair:>16.0f}')
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+assert __name__ == '__main__'
+
+# Shim startup: time from spawning `pydra ccerb cc -c x.c` to its job_server connection,
+# which is everything a compile pays before dispatch. We stand in for job_server, in a
+# scratch HOME, then let the shim fall back to compiling locally.
+#
+# usage: bench_startup.py [runs] [cc] [pydra]
+
+import os
+import pathlib
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+NUM_RUNS = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+CC = sys.argv[2] if len(sys.argv) > 2 else 'gcc'
+PYDRA = sys.argv[3] if len(sys.argv) > 3 else str(pathlib.Path(__file__).parent / 'pydra')
+
+# --
+
+def time_python(code):
+    t0 = time.perf_counter()
+    subprocess.run([sys.executable, '-c', code], check=True)
+    return time.perf_counter() - t0
+
+
+def time_to_dispatch(server, cwd, env):
+    t0 = time.perf_counter()
+    p = subprocess.Popen([sys.executable, PYDRA, 'ccerb', CC, '-c', 'x.c'], cwd=cwd, env=env,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    (conn, _) = server.accept()
+    secs = time.perf_counter() - t0
+    conn.close()
+    p.wait()
+    return secs
+
+
+def report(name, samples):
+    samples = [x * 1000 for x in samples]
+    print(f'{name:>20}: median {statistics.median(samples):7.2f}ms' +
+          f'  min {min(samples):7.2f}ms')
+
+# --
+
+with tempfile.TemporaryDirectory() as home:
+    server = socket.create_server(('127.0.0.1', 0))
+    pydra_home = pathlib.Path(home) / '.pydra'
+    pydra_home.mkdir()
+    (pydra_home / 'config.py').write_text('\n'.join([
+        f'JOB_SERVER_ADDR = {server.getsockname()!r}',
+        'LOG_ADDR = ("127.0.0.1", 1)',
+        f'SESSION_SOCKET_PATH = {str(pydra_home / "none.sock")!r}',
+    ]))
+    (pathlib.Path(home) / 'x.c').write_text('int x;\n')
+    env = dict(os.environ, HOME=home, USERPROFILE=home)
+
+    print(f'{NUM_RUNS} runs of {PYDRA} ccerb {CC} -c x.c')
+    report('python -c pass', [time_python('pass') for _ in range(NUM_RUNS)])
+    time_to_dispatch(server, home, env) # Warm the shim's caches.
+    report('time to dispatch', [time_to_dispatch(server, home, env) for _ in range(NUM_RUNS)])
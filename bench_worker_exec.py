@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+assert __name__ == '__main__'
+
+# Per-job overhead of ccerb's worker-side execution: a temp dir, the compiler process and
+# cleanup, as before (mkdtemp, Popen and renice, rmtree) vs now (pooled scratch dirs and
+# pre-spawned launchers). The "compiler" does next to nothing, so this is all overhead.
+#
+# usage: bench_worker_exec.py [jobs] [cmd ...]
+
+import sys
+
+NUM_JOBS = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+CMD = sys.argv[2:] or [sys.executable, '-S', '-c', 'open("a.o", "wb").write(bytes(10000))']
+sys.argv = sys.argv[:1] # Keep common's -v parsing away from CMD.
+
+from common import *
+
+ccerb = LoadPydraModule('ccerb')
+
+# --
+
+def job(fn_temp_dir):
+    with fn_temp_dir() as temp_dir:
+        (retcode, _, _, _) = ccerb.run_compiler(temp_dir.path, CMD)
+        assert retcode == 0
+        ccerb.list_files(temp_dir.path)
+
+
+def bench(fn_temp_dir, use_launchers):
+    ccerb.USE_LAUNCHERS = use_launchers
+    for _ in range(10): # Warm up, and let the launcher pool fill.
+        job(fn_temp_dir)
+    time.sleep(0.5)
+
+    t0 = time.perf_counter()
+    for _ in range(NUM_JOBS):
+        job(fn_temp_dir)
+    return (time.perf_counter() - t0) / NUM_JOBS
+
+# --
+
+print(f'{NUM_JOBS} jobs of {CMD}')
+old = bench(ccerb.ScopedTempDir, False)
+print(f'{"mkdtemp + Popen":>24}: {old * 1000:.3f}ms/job')
+new = bench(ccerb.ScratchDir, True)
+print(f'{"scratch dirs + launchers":>24}: {new * 1000:.3f}ms/job')
@@ -4,20 +4,18 @@ assert __name__ != '__main__'
 import net_utils as nu
 
 import logging
+import marshal
 import os
 import pathlib
-import platform
 import socket
 import struct
-import subprocess
 import sys
 import threading
 import time
-import traceback
 
 # --
 
-SEMVER_MAJOR = 4
+SEMVER_MAJOR = 16
 nu.PacketConn.MAGIC += nu.pack_t(nu.U32_T, SEMVER_MAJOR)
 
 PYDRA_HOME = pathlib.Path.home() / '.pydra'
@@ -54,9 +52,22 @@ DEFAULT_CONFIG = {
     'TIMEOUT_CLIENT_TO_SERVER': 0.300,
     'TIMEOUT_WORKER_TO_SERVER': 3.000,
     'TIMEOUT_TO_WORKER': 0.300,
+    'TIMEOUT_SLOT_LEASE': 3.000,
     'TIMEOUT_TO_LOG': 0.300,
     'KEEPALIVE_TIMEOUT': 1.000,
     'LOG_LEVEL': logging.WARNING,
+    'EVENT_SERVER': False, # Serve all connections from one selector thread.
+    # weighted-random, prefer-local, least-loaded, lowest-rtt, or cache-affinity.
+    'SCHEDULING_POLICY': 'weighted-random',
+    # Secs for a host's slot-second usage to decay by half, for fair share across hosts.
+    'FAIR_SHARE_HALF_LIFE': 3600.0,
+    # Records/sec each shim may send to the worker's log server (0 for unlimited), bursting
+    # to LOG_BURST_SECS worth. Past that, they're dropped and counted.
+    'LOG_RATE_LIMIT': 200,
+    'LOG_BURST_SECS': 5.0,
+    'SESSION_SOCKET_PATH': (PYDRA_HOME / 'session.sock').as_posix(),
+    # Secs before a cached mDNS job_server address is rechecked in the background.
+    'MDNS_CACHE_TTL': 60.0,
 }
 
 # --
@@ -71,11 +82,18 @@ F64_T = struct.Struct('<d')
 
 # --
 
+# Beside `path`, and unique to this thread, to write and then os.replace() into place.
+def temp_path_for(path):
+    return path.with_suffix('.tmp{}-{}'.format(os.getpid(), threading.get_ident()))
+
+# -
+
 def make_key(mod_name, subkey):
     return mod_name.encode() + b'|' + subkey
 
 
 def key_from_call(args, **kwargs):
+    import subprocess # Only when config runs it, which is at most once per cc.
     p = subprocess.run(args, check=True, capture_output=True, **kwargs)
     return p.stderr + p.stdout
 
@@ -86,11 +104,34 @@ CONFIG_GLOBALS = {
 
 # --
 
+# Every shim runs config.py, and Python only caches bytecode for imports, so we cache its
+# code ourselves, keyed on its mtime and size.
+CONFIG_CODE_PATH = PYDRA_HOME / 'config.code'
+
+def load_config_code():
+    st = CONFIG_PATH.stat()
+    stamp = '{} {} {}'.format(st.st_mtime_ns, st.st_size, sys.version).encode()
+    try:
+        (header, body) = CONFIG_CODE_PATH.read_bytes().split(b'\n', 1)
+        if header == stamp:
+            return marshal.loads(body)
+    except (OSError, ValueError, EOFError, TypeError):
+        pass
+
+    code = compile(CONFIG_PATH.read_bytes(), CONFIG_PATH.as_posix(), 'exec', optimize=0)
+    temp_path = temp_path_for(CONFIG_CODE_PATH)
+    try:
+        temp_path.write_bytes(stamp + b'\n' + marshal.dumps(code))
+        os.replace(temp_path, CONFIG_CODE_PATH)
+    except OSError:
+        pass
+    return code
+
+# -
+
 CONFIG = dict(DEFAULT_CONFIG)
 if CONFIG_PATH.exists():
-    code = CONFIG_PATH.read_bytes()
-    code = compile(code, CONFIG_PATH.as_posix(), 'exec', optimize=0)
-    exec(code, CONFIG_GLOBALS, CONFIG)
+    exec(load_config_code(), CONFIG_GLOBALS, CONFIG)
     # For example, CONFIG['CC_LIST'] can be modified in ~/.pydra/config.py as `CC_LIST +=`.
 
 # --
@@ -189,6 +230,25 @@ def nice_down(pid=None):
     except PermissionError:
         logging.warning('Warning: p.nice() failed.')
 
+
+# Kills `p` (a Popen) and its descendants. Without psutil, just `p`.
+def kill_tree(p):
+    children = []
+    try:
+        import psutil
+        children = psutil.Process(p.pid).children(recursive=True)
+    except ModuleNotFoundError:
+        pass
+    except psutil.Error:
+        pass # Already gone.
+
+    p.kill()
+    for x in children:
+        try:
+            x.kill()
+        except psutil.Error:
+            pass
+
 # --
 
 class Packetable(object):
@@ -263,6 +323,20 @@ class WorkerDescriptor(Packetable):
 
 # --
 
+# `accepted` counts every job connection the worker has ever taken, so job_server can
+# tell which of its assignments the worker has seen.
+class SlotReport(Packetable):
+    def encode_into(self, bw):
+        bw.pack_t(F64_T, self.avail_slots)
+        bw.pack_t(U64_T, self.accepted)
+
+
+    def decode_from(self, br):
+        self.avail_slots = br.unpack_t(F64_T)
+        self.accepted = br.unpack_t(U64_T)
+
+# --
+
 class JobWorkersDescriptor(Packetable):
     def encode_into(self, bw):
         bw.pack_t(U16_T, self.local_slots)
@@ -275,6 +349,7 @@ class JobWorkersDescriptor(Packetable):
 # --
 
 def dump_thread_stacks():
+    import traceback
     for (k,v) in sys._current_frames().items():
         stack = traceback.format_stack(f=v)
         text = '\nThread {}:\n{}'.format(hex(k), '\n'.join(stack))
@@ -312,27 +387,113 @@ class MsTimer(object):
 
 JOB_SERVER_MDNS_SERVICE = 'job_server._pydra._tcp.local.'
 
-def job_server_addr(timeout):
-    addr = CONFIG['JOB_SERVER_ADDR']
-    if addr[0]:
-        return (*addr, None)
-
+def query_job_server_mdns(timeout):
     try:
         import zeroconf
     except ImportError:
         logging.error('JOB_SERVER_ADDR[0]='' requires `pip install zeroconf`.')
         return None
     zc = zeroconf.Zeroconf()
-
-    logging.info('Querying mDNS...')
-    info = zc.get_service_info(JOB_SERVER_MDNS_SERVICE, JOB_SERVER_MDNS_SERVICE,
-            timeout=timeout*1000)
+    try:
+        logging.info('Querying mDNS...')
+        info = zc.get_service_info(JOB_SERVER_MDNS_SERVICE, JOB_SERVER_MDNS_SERVICE,
+                timeout=timeout*1000)
+    finally:
+        zc.close()
     if not info:
         return None
     host = socket.inet_ntop(socket.AF_INET, info.address)
     logging.info('mDNS resolved %s as %s (%s).', JOB_SERVER_MDNS_SERVICE, host, info.server)
     return (host, info.port, info.server)
 
+# -
+
+# Every shim would otherwise pay for a Zeroconf instance and a blocking query, so the last
+# answer is kept in ~/.pydra/job_server_mdns.json. Past MDNS_CACHE_TTL secs since it was last
+# checked, the next shim rechecks it, but only waits RECHECK_TIMEOUT for an answer (a shim
+# would exit before a background query finished). Without one, the last known address stays.
+class MdnsCache(object):
+    RECHECK_TIMEOUT = 0.2
+
+    def __init__(self, path, ttl):
+        self.path = pathlib.Path(path)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.addr = None
+        self.checked = 0.0
+        try:
+            import json
+            data = json.loads(self.path.read_text())
+            self.addr = tuple(data['addr'])
+            self.checked = data['checked']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+
+    def save(self):
+        import json
+        with self.lock:
+            text = json.dumps({'addr': self.addr, 'checked': self.checked})
+        temp_path = temp_path_for(self.path)
+        try:
+            temp_path.write_text(text)
+            os.replace(temp_path, self.path)
+        except OSError:
+            pass
+
+
+    def query(self, timeout):
+        addr = query_job_server_mdns(timeout)
+        with self.lock:
+            self.checked = time.time()
+            if addr:
+                self.addr = addr
+            else:
+                addr = self.addr # Keep the last known address.
+        self.save()
+        return addr
+
+
+    def get(self, timeout, fresh=False):
+        if fresh:
+            return self.query(timeout)
+
+        with self.lock:
+            addr = self.addr
+            stale = time.time() - self.checked > self.ttl
+        if not addr:
+            return self.query(timeout)
+        if stale:
+            return self.query(min(timeout, self.RECHECK_TIMEOUT))
+        return addr
+
+
+MDNS_CACHE = None
+
+def job_server_addr(timeout, fresh=False):
+    addr = CONFIG['JOB_SERVER_ADDR']
+    if addr[0]:
+        return (*addr, None)
+
+    global MDNS_CACHE
+    if not MDNS_CACHE:
+        MDNS_CACHE = MdnsCache(PYDRA_HOME / 'job_server_mdns.json', CONFIG['MDNS_CACHE_TTL'])
+    return MDNS_CACHE.get(timeout, fresh)
+
+
+def connect_job_server(timeout):
+    addr = job_server_addr(timeout)
+    if not addr:
+        return (None, None)
+    conn = nu.connect_any([addr[:2]], timeout=timeout)
+    if not conn and not CONFIG['JOB_SERVER_ADDR'][0]:
+        # A cached mDNS answer may have gone stale, so ask again before giving up.
+        new_addr = job_server_addr(timeout, fresh=True)
+        if new_addr != addr:
+            addr = new_addr
+            conn = nu.connect_any([addr[:2]], timeout=timeout)
+    return (addr, conn)
+
 # --
 
 MODULE_DIRS = [
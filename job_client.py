@@ -9,41 +9,79 @@ LOCAL_SPEW = False
 
 # --
 
+# Records are buffered, and shipped in batches: when FLUSH_BYTES are pending, FLUSH_SECS after
+# the oldest, on anything at FLUSH_LEVEL, and at exit (via logging.shutdown). The connection is
+# made on the first flush, so a shim that logs nothing never connects, and has no keepalive
+# thread: The log server doesn't time out its shims.
 class LogToWorker(logging.Handler):
+    FLUSH_BYTES = 64 * 1024
+    FLUSH_SECS = 1.0
+    FLUSH_LEVEL = logging.ERROR
+
     def __init__(self, addr):
         super().__init__()
 
         self.addr = addr
         self.lock = threading.RLock()
         self.pconn = None
+        self.pending = []
+        self.pending_bytes = 0
+        self.pending_since = None
 
 
     def close(self):
+        self.flush()
         with self.lock:
             if self.pconn:
-                self.pconn.nuke()
+                self.pconn.send_shutdown() # Unlike nuking, lets the server read everything.
+            self.pconn = False
         super().close()
 
 
     def emit(self, record):
         text = self.format(record).encode()
-        try:
-            with self.lock:
-                if self.pconn == None:
-                    self.pconn = False
-                    conn = nu.connect_any([self.addr], timeout=CONFIG['TIMEOUT_TO_LOG'])
-                    if conn:
-                        self.pconn = nu.PacketConn(conn, CONFIG['KEEPALIVE_TIMEOUT'], True)
+        with self.lock:
+            if not self.pending:
+                self.pending_since = time.monotonic()
+            self.pending.append(text)
+            self.pending_bytes += len(text)
+            if (self.pending_bytes >= self.FLUSH_BYTES or record.levelno >= self.FLUSH_LEVEL or
+                    time.monotonic() - self.pending_since >= self.FLUSH_SECS):
+                self.flush()
 
-            if self.pconn:
-                self.pconn.send(text)
+
+    def flush(self):
+        with self.lock:
+            (pending, self.pending) = (self.pending, [])
+            self.pending_bytes = 0
+            if not pending:
+                return
+            try:
+                self._send(pending)
                 return
+            except OSError:
+                pass
+
+            log_path = PYDRA_HOME / 'failsafe.log'
+            try:
+                with log_path.open('ab') as f:
+                    f.write(b''.join(x + b'\n' for x in pending))
+            except OSError:
+                pass
+
+
+    def _send(self, pending):
+        if self.pconn == None:
+            self.pconn = False
+            conn = socket.create_connection(self.addr, timeout=CONFIG['TIMEOUT_TO_LOG'])
+            self.pconn = nu.PacketConn(conn)
+        if not (self.pconn and self.pconn.alive):
+            raise OSError('No connection to log server.')
+        try:
+            self.pconn.send_batch(pending)
         except OSError:
-            pass
-
-        log_path = PYDRA_HOME / 'failsafe.log'
-        with log_path.open('ab', buffering=0) as f:
-            f.write(text.decode())
+            self.pconn.nuke() # Maybe mid-packet.
+            raise
 
 
     @staticmethod
@@ -68,16 +106,37 @@ class PydraInterface(object):
         return self.python_module.pydra_shim(self, *args)
 
 
-    def register_job(self, subkey):
+    def connect_to_session_agent(self):
+        path = CONFIG['SESSION_SOCKET_PATH']
+        if not (path and hasattr(socket, 'AF_UNIX')):
+            return None
+        conn = socket.socket(socket.AF_UNIX)
+        try:
+            conn.settimeout(CONFIG['TIMEOUT_CLIENT_TO_SERVER'])
+            conn.connect(path)
+            conn.settimeout(None)
+        except OSError:
+            nu.nuke_socket(conn)
+            return None
+        logging.debug('Connected to session agent at %s.', path)
+        return nu.PacketConn(conn) # Local, so no keepalives.
+
+
+    def connect_to_server(self):
         timeout = CONFIG['TIMEOUT_CLIENT_TO_SERVER']
-        addr = job_server_addr(timeout)
+        (addr, conn) = connect_job_server(timeout)
         if not addr:
             raise OSError('Failed to resolve mDNS job_server.')
-        conn = nu.connect_any([addr[:2]], timeout=timeout)
         if not conn:
             raise OSError(f'Failed to connect to server: {addr}')
 
-        pconn = nu.PacketConn(conn, CONFIG['KEEPALIVE_TIMEOUT'], True)
+        return nu.PacketConn(conn, CONFIG['KEEPALIVE_TIMEOUT'], True)
+
+
+    def register_job(self, subkey):
+        pconn = self.connect_to_session_agent()
+        if not pconn:
+            pconn = self.connect_to_server()
         pconn.send(b'job')
 
         job = RegisteredJob(self, subkey, pconn)
@@ -88,6 +147,17 @@ class PydraInterface(object):
 
 # -
 
+# Modules' workers may treat any packet after a job's inputs as a cancel, but a disconnect
+# has to do anyway, for clients that die.
+def cancel_worker(worker_pconn):
+    try:
+        worker_pconn.send(b'cancel')
+    except OSError:
+        pass
+    worker_pconn.nuke()
+
+# -
+
 class RegisteredJob(object):
     def __init__(self, iface, subkey, server_pconn):
         self.iface = iface
@@ -101,18 +171,74 @@ class RegisteredJob(object):
         return JobWorkersDescriptor.decode(self.server_pconn.recv())
 
 
+    def request_workers(self, n):
+        with self.server_pconn.slock:
+            self.server_pconn.send(b'request_workers')
+            self.server_pconn.send_t(U32_T, n)
+
+
+    # Jobs with the same token prefer the same worker, under the cache-affinity policy.
+    def set_affinity(self, token):
+        with self.server_pconn.slock:
+            self.server_pconn.send(b'affinity')
+            self.server_pconn.send(token)
+
+
+    # Queued requests go by higher `priority`, then higher expected `cost` (longest-first),
+    # then FIFO, among this host's jobs.
+    def set_hints(self, priority=0, cost=0.0):
+        with self.server_pconn.slock:
+            self.server_pconn.send(b'hints')
+            self.server_pconn.send_t(I32_T, priority)
+            self.server_pconn.send_t(F64_T, cost)
+
+
+    # Requests from here on aren't matched with workers on `hostname`. '' clears it.
+    def exclude_host(self, hostname):
+        with self.server_pconn.slock:
+            self.server_pconn.send(b'exclude')
+            self.server_pconn.send(hostname.encode())
+
+
+    def cancel_requests(self):
+        self.server_pconn.send(b'cancel_requests')
+
+
+    # One per requested worker, as the server matches them.
+    def recv_assignment(self):
+        return WorkerAssignmentPacket.decode(self.server_pconn.recv())
+
+
     def dispatch(self, *args, **kwargs):
         self.server_pconn.send(b'request_worker')
-        wap = WorkerAssignmentPacket.decode(self.server_pconn.recv())
+        return self.dispatch_to(self.recv_assignment(), *args, **kwargs)
 
+
+    # Returns None if the worker couldn't take it, so callers can retry. `on_connect` gets
+    # the worker's pconn, e.g. to cancel by nuking it.
+    def dispatch_to(self, wap, *args, on_connect=None, **kwargs):
         addrs = [x.addr for x in wap.addrs]
+        t = time.perf_counter()
         worker_conn = nu.connect_any(addrs, timeout=CONFIG['TIMEOUT_TO_WORKER'])
         if not worker_conn:
             logging.error('Failed to connect to worker: %s@%s', wap.hostname, addrs)
+            self._report_done(wap, 0.0) # Every assignment gets one, for fair share.
             return None
 
+        # For the lowest-rtt policy. Connecting is about one round trip.
+        try:
+            with self.server_pconn.slock:
+                self.server_pconn.send(b'rtt')
+                self.server_pconn.send(wap.hostname.encode())
+                self.server_pconn.send_t(F64_T, time.perf_counter() - t)
+        except OSError:
+            pass
+
         worker_pconn = nu.PacketConn(worker_conn, CONFIG['KEEPALIVE_TIMEOUT'], True)
+        t = time.perf_counter()
         try:
+            if on_connect:
+                on_connect(worker_pconn)
             worker_pconn.send(CONFIG['HOSTNAME'].encode())
             worker_pconn.send(self.key)
 
@@ -122,3 +248,137 @@ class RegisteredJob(object):
             return None
         finally:
             worker_pconn.nuke()
+            self._report_done(wap, time.perf_counter() - t)
+
+
+    # For an assignment we won't use: Frees its slot lease, and undoes its charge.
+    def _decline(self, wap):
+        try:
+            with self.server_pconn.slock:
+                self.server_pconn.send(b'decline')
+                self.server_pconn.send(wap.hostname.encode())
+        except OSError:
+            pass
+        self._report_done(wap, 0.0)
+
+
+    # For fair share: slot-seconds we used, and the worker's host contributed.
+    def _report_done(self, wap, secs):
+        try:
+            with self.server_pconn.slock:
+                self.server_pconn.send(b'done')
+                self.server_pconn.send(wap.hostname.encode())
+                self.server_pconn.send_t(F64_T, secs)
+        except OSError:
+            pass
+
+
+    # Runs pydra_job_client for each entry of `args_list` concurrently, over one request
+    # for all of them, each starting as soon as its worker is assigned. Failures are
+    # re-requested after the round. Returns results in order.
+    def dispatch_many(self, args_list):
+        rets = [None] * len(args_list)
+        todo = list(range(len(args_list)))
+        while todo:
+            self.request_workers(len(todo))
+            threads = []
+            for i in todo:
+                wap = self.recv_assignment()
+                def th_dispatch(i=i, wap=wap):
+                    rets[i] = self.dispatch_to(wap, *args_list[i])
+                t = threading.Thread(target=th_dispatch, daemon=True)
+                t.start()
+                threads.append(t)
+            for t in threads:
+                t.join()
+            todo = [i for i in todo if rets[i] is None]
+        return rets
+
+
+    # Like dispatch(), but if there's no result `deadline` secs after the first worker
+    # started, races a duplicate on another worker. The first truthy result wins, and the
+    # other attempt is cancelled. Results that lose anyway go to `fn_discard`.
+    # If no attempt succeeds, the first exception one raised is re-raised, as dispatch() would.
+    # The duplicate is never matched with the first attempt's host. Once there's a result, an
+    # unneeded duplicate request is cancelled, but its assignment may still arrive (and is
+    # declined), so don't dispatch more on this job afterwards. Without a result, it's safe.
+    def dispatch_speculative(self, deadline, *args, fn_discard=None, **kwargs):
+        cv = threading.Condition(threading.Lock())
+        cv.pending = 0 # Attempts that may yet return, including a requested duplicate.
+        cv.ret = None
+        cv.ex = None # Re-raised if no attempt succeeds, like dispatch() would.
+        cv.pconns = []
+
+        def on_connect(pconn):
+            with cv:
+                cv.pconns.append(pconn)
+                if cv.ret:
+                    cancel_worker(pconn) # Lost before starting.
+
+        def th_attempt(wap):
+            ret = None
+            try:
+                ret = self.dispatch_to(wap, *args, on_connect=on_connect, **kwargs)
+            except Exception as e:
+                with cv:
+                    cv.ex = cv.ex or e
+            finally:
+                with cv:
+                    cv.pending -= 1
+                    is_loser = ret and cv.ret
+                    if ret and not cv.ret:
+                        cv.ret = ret
+                        [cancel_worker(x) for x in cv.pconns]
+                    cv.notify_all()
+                if is_loser and fn_discard:
+                    fn_discard(ret)
+
+        def start_attempt(wap):
+            threading.Thread(target=th_attempt, args=(wap,), daemon=True).start()
+
+        def th_duplicate():
+            try:
+                wap = self.recv_assignment()
+            except OSError:
+                wap = None
+            with cv:
+                if wap and not cv.ret:
+                    start_attempt(wap)
+                    return
+                cv.pending -= 1
+                cv.notify_all()
+            if wap:
+                self._decline(wap) # Lost before it arrived.
+
+        self.server_pconn.send(b'request_worker')
+        first = self.recv_assignment()
+        with cv:
+            cv.pending += 1
+            start_attempt(first)
+            if cv.wait_for(lambda: cv.pending == 0, deadline):
+                if not cv.ret and cv.ex:
+                    raise cv.ex
+                return cv.ret
+
+            logging.info('Job %s@%s passed its %.3fs deadline. Racing a duplicate...',
+                    self.subkey, first.hostname, deadline)
+            cv.pending += 1
+        # Affinity would just pick the same worker again.
+        self.set_affinity(b'')
+        self.exclude_host(first.hostname)
+        self.server_pconn.send(b'request_worker')
+        threading.Thread(target=th_duplicate, daemon=True).start()
+
+        with cv:
+            cv.wait_for(lambda: cv.ret or cv.pending == 0)
+            ret = cv.ret
+        if ret:
+            try:
+                self.cancel_requests()
+            except OSError:
+                pass
+            return ret
+        self.exclude_host('') # Both attempts are done, so a retry may go anywhere.
+        if cv.ex:
+            raise cv.ex
+        return None
@@ -2,27 +2,23 @@
 assert __name__ == '__main__'
 
 from common import *
+import matchmaking
 import net_utils as nu
 
+import collections
 import itertools
 import os
-import random
 import signal
-
-g_cvar = threading.Condition(threading.Lock())
-job_queue_by_key = {}
-available_workers_by_key = {}
+import traceback
+
+# Matchmaking state is sharded per key, with its own locks. These cover the rest.
+g_rtts = matchmaking.RttTable()
+g_fair_share = matchmaking.FairShare(CONFIG['FAIR_SHARE_HALF_LIFE'])
+g_matchmaker = matchmaking.Matchmaker(
+        matchmaking.make_policy(CONFIG['SCHEDULING_POLICY'], g_rtts), g_fair_share)
+g_workers_lock = threading.Lock()
 connected_workers = set()
 connected_workers_by_key = {}
-karma_by_hostname = {}
-
-# --
-
-def add_karma_by_hostname(hostname, karma):
-    try:
-        karma_by_hostname[hostname] += karma
-    except KeyError:
-        karma_by_hostname[hostname] = karma
 
 # --
 
@@ -38,7 +34,13 @@ class Job(object):
         self.hostname = hostname
         self.key = key
         self.id = next(self.next_id)
-        self._active = False
+        self.lock = threading.Lock()
+        self.wanted = 0 # Outstanding worker requests. Queued while non-zero.
+        self.affinity = b'' # For the cache-affinity policy.
+        self.exclude = '' # A worker host not to match us with, e.g. for a duplicate.
+        self.priority = 0
+        self.cost = 0.0 # Expected, in any unit comparable across the host's jobs.
+        self.charges = collections.deque() # Fair-share charges, reversed as each is done.
 
         logging.debug('%s connected.', self)
         return
@@ -46,8 +48,7 @@ class Job(object):
 
     def close(self):
         logging.debug('%s disconnected.', self)
-        with g_cvar:
-            self.set_active(False)
+        self.cancel_requests()
         self.pconn.nuke()
 
 
@@ -59,24 +60,42 @@ class Job(object):
         return 'Job{}@{}'.format(self.id, self.hostname)
 
 
-    def set_active(self, new_val):
-        plusminus = ('-', '+')
-        logging.debug('{}{}'.format(plusminus[int(new_val)], self))
-        assert not g_cvar.acquire(False)
-        if self._active == new_val:
-            return
-        logging.info('{}{}'.format(plusminus[int(new_val)], self))
-        self._active = new_val
-
-        job_queue = job_queue_by_key.setdefault(self.key, [])
-        if new_val:
-            job_queue.append(self)
-            job_queue.sort()
-            g_cvar.notify()
-        else:
-            job_queue.remove(self)
-            if not job_queue:
-                del job_queue_by_key[self.key]
+    def request(self, n):
+        logging.debug('+%s (%i)', self, n)
+        with self.lock:
+            was_queued = bool(self.wanted)
+            self.wanted += n
+            if self.wanted and not was_queued:
+                logging.info('+%s', self)
+                g_matchmaker.add_job(self)
+
+
+    def set_hints(self, priority, cost):
+        with self.lock:
+            self.priority = priority
+            self.cost = cost
+            g_matchmaker.reorder_job(self)
+
+
+    def cancel_requests(self):
+        with self.lock:
+            if not self.wanted:
+                return
+            logging.info('-%s', self)
+            self.wanted = 0
+            g_matchmaker.remove_job(self)
+
+
+    # The matchmaker popped us. Requeue (keeping our place) if we want more.
+    def on_matched(self):
+        with self.lock:
+            if not self.wanted:
+                return # Cancelled meanwhile.
+            self.wanted -= 1
+            if self.wanted:
+                g_matchmaker.add_job(self)
+            else:
+                logging.info('-%s', self)
 
 # --
 
@@ -86,13 +105,20 @@ class Worker(object):
     def __init__(self, pconn, desc):
         self.pconn = pconn
         self.desc = desc
-        self.avail_slots = 0.0
+        self.hostname = desc.hostname
+        self.max_slots = desc.max_slots
         self.id = next(self.next_id) # Purely informational.
+        self.lock = threading.Lock()
         self._active = False
 
+        # Slots are leased on assignment, and reconciled against the worker's reports.
+        self.avail_slots = 0.0 # As last reported.
+        self.accepted = 0 # Job connections the worker had seen, as last reported.
+        self.leases = collections.deque() # Times of assignments it hadn't seen yet.
+
         logging.warning('%s connected', self)
 
-        with g_cvar:
+        with g_workers_lock:
             connected_workers.add(self)
 
             for key in self.desc.keys:
@@ -103,9 +129,13 @@ class Worker(object):
     def close(self):
         logging.warning('%s disconnected.', self)
 
-        with g_cvar:
-            self.set_active(False)
+        with self.lock:
+            self.avail_slots = 0.0
+            self.leases.clear()
+            self._update()
 
+        workerless_keys = []
+        with g_workers_lock:
             connected_workers.remove(self)
 
             for key in self.desc.keys:
@@ -113,14 +143,12 @@ class Worker(object):
                 workers.remove(self)
                 if not workers:
                     del connected_workers_by_key[key]
+                    workerless_keys.append(key)
 
-                    # Purge outstanding jobs for the now-workerless key.
-                    try:
-                        for queue in job_queue_by_key[key]:
-                            for j in queue:
-                                j.pconn.nuke()
-                    except KeyError:
-                        pass
+        # Purge outstanding jobs for the now-workerless keys.
+        for key in workerless_keys:
+            for j in g_matchmaker.jobs(key):
+                j.pconn.nuke()
         self.pconn.nuke()
 
 
@@ -128,44 +156,74 @@ class Worker(object):
         return 'Worker{}@{}'.format(self.id, self.desc.hostname)
 
 
-    def set_active(self, new_val):
-        plusminus = ('-', '+')
-        logging.debug('{}{}'.format(plusminus[int(new_val)], self))
-        assert not g_cvar.acquire(False)
-        if self._active == new_val:
-            return
-        logging.info('{}{}'.format(plusminus[int(new_val)], self))
-        self._active = new_val
+    def free_slots(self):
+        return self.avail_slots - len(self.leases)
+
 
+    def _update(self):
+        assert self.lock.locked()
+        free_slots = max(self.free_slots(), 0.0)
         for key in self.desc.keys:
-            workers = available_workers_by_key.setdefault(key, [])
-            if new_val:
-                workers.append(self)
-                g_cvar.notify()
-            else:
-                workers.remove(self)
-                if not workers:
-                    del available_workers_by_key[key]
+            g_matchmaker.set_worker(self, key, free_slots)
 
+        new_val = bool(free_slots)
+        plusminus = ('-', '+')
+        logging.debug('{}{}'.format(plusminus[int(new_val)], self))
+        if self._active != new_val:
+            logging.info('{}{}'.format(plusminus[int(new_val)], self))
+            self._active = new_val
         stats_changed()
 
+
+    def take_lease(self):
+        with self.lock:
+            self.leases.append(time.monotonic())
+            self._update()
+
+
+    # An assignment the client declined, so it'll never show up here.
+    def release_lease(self):
+        with self.lock:
+            if self.leases:
+                self.leases.pop()
+                self._update()
+
+
+    def on_report(self, report):
+        with self.lock:
+            # Assignments whose jobs never showed up.
+            cutoff = time.monotonic() - CONFIG['TIMEOUT_SLOT_LEASE']
+            while self.leases and self.leases[0] < cutoff:
+                self.leases.popleft()
+
+            # The worker has seen this many more of our assignments. Any beyond our
+            # remaining leases were for ones that already expired.
+            for _ in range(report.accepted - self.accepted):
+                if not self.leases:
+                    break
+                self.leases.popleft()
+            self.accepted = report.accepted
+            self.avail_slots = report.avail_slots
+
+            self._update()
+
 # --
 
 def job_accept(pconn):
     job = None
     try:
-        hostname = pconn.recv().decode()
-        key = pconn.recv()
+        hostname = (yield).decode()
+        key = yield
 
         job = Job(pconn, hostname, key)
         while True:
             # Remote will kill socket if its done.
-            cmd = pconn.recv()
+            cmd = yield
             if cmd == b'job_workers':
                 info = JobWorkersDescriptor()
                 info.local_slots = 0
                 info.remote_slots = 0
-                with g_cvar:
+                with g_workers_lock:
                     try:
                         for worker in connected_workers_by_key[key]:
                             worker_slots = worker.desc.max_slots
@@ -179,16 +237,62 @@ def job_accept(pconn):
                 continue
 
             elif cmd == b'request_worker':
-                with g_cvar:
-                    job.set_active(True)
+                job.request(1)
+                continue
+
+            elif cmd == b'request_workers':
+                # Each assignment streams back as a WorkerAssignmentPacket as it's matched.
+                n = nu.unpack_t(U32_T, (yield))
+                job.request(n)
+                continue
+
+            elif cmd == b'cancel_requests':
+                job.cancel_requests()
+                continue
+
+            elif cmd == b'affinity':
+                job.affinity = yield
+                continue
+
+            elif cmd == b'exclude': # For requests from here on.
+                job.exclude = (yield).decode()
+                continue
+
+            elif cmd == b'decline': # An assignment that the client won't use.
+                worker_hostname = (yield).decode()
+                with g_workers_lock:
+                    workers = [w for w in connected_workers_by_key.get(key, ())
+                               if w.hostname == worker_hostname]
+                for w in workers:
+                    if w.leases:
+                        w.release_lease()
+                        break
+                continue
+
+            elif cmd == b'hints': # For ordering our requests. See matchmaking.job_order.
+                priority = nu.unpack_t(I32_T, (yield))
+                cost = nu.unpack_t(F64_T, (yield))
+                job.set_hints(priority, cost)
+                continue
+
+            elif cmd == b'rtt': # How long connecting to a worker took.
+                worker_hostname = (yield).decode()
+                secs = nu.unpack_t(F64_T, (yield))
+                g_rtts.add_sample(hostname, worker_hostname, secs)
                 continue
 
-            elif cmd == b'karma': # TODO: Something like this?
-                to_hostname = pconn.recv().decode()
-                points = pconn.recv_t(F64_T)
-                with g_cvar:
-                    add_karma_by_hostname(to_hostname, points)
-                    add_karma_by_hostname(hostname, -points)
+            elif cmd == b'done': # How long a job ran on a worker.
+                worker_hostname = (yield).decode()
+                secs = nu.unpack_t(F64_T, (yield))
+                charged = job.charges.popleft() if job.charges else 0.0
+                g_fair_share.on_done(hostname, worker_hostname, key, secs, charged)
+                continue
+
+            elif cmd == b'karma': # Give some of our fair share to another host.
+                to_hostname = (yield).decode()
+                points = nu.unpack_t(F64_T, (yield))
+                g_fair_share.add_karma(to_hostname, points)
+                g_fair_share.add_karma(hostname, -points)
                 continue
 
             logging.warning('%s: Bad cmd: %s', job, cmd)
@@ -204,16 +308,14 @@ def job_accept(pconn):
 def worker_accept(pconn):
     worker = None
     try:
-        desc = WorkerDescriptor.decode(pconn.recv())
+        desc = WorkerDescriptor.decode((yield))
         worker = Worker(pconn, desc)
 
         while pconn.alive:
-            avail_slots = pconn.recv_t(F64_T)
-            with g_cvar:
-                worker.avail_slots = avail_slots
-                logging.info('%s.avail_slots = %.2f', worker, worker.avail_slots)
-                stats_changed()
-                worker.set_active(bool(worker.avail_slots))
+            report = SlotReport.decode((yield))
+            logging.info('%s.avail_slots = %.2f (accepted %i)', worker, report.avail_slots,
+                    report.accepted)
+            worker.on_report(report)
     except OSError:
         pass
     finally:
@@ -223,25 +325,32 @@ def worker_accept(pconn):
 # -
 
 def stats():
-    assert not g_cvar.acquire(False)
+    with g_workers_lock:
+        workers = list(connected_workers)
+        workers_by_key = [(k, list(ws)) for (k,ws) in connected_workers_by_key.items()]
+
+    # Slot counts are read racily, which is fine for display.
     lines = ['Stats:']
-    lines.append(f'  {len(connected_workers)} workers:')
-    for w in connected_workers:
+    lines.append(f'  {len(workers)} workers:')
+    for w in workers:
         name = w.desc.hostname
-        lines.append(f'    slots: {w.avail_slots:.2f}/{w.desc.max_slots}\t{name}\t{w.desc.keys}')
+        lines.append(f'    slots: {w.free_slots():.2f}/{w.desc.max_slots}\t' +
+                     f'leased: {len(w.leases)}\t{name}\t{w.desc.keys}')
 
-    lines.append(f'  {len(connected_workers_by_key)} keys:')
-    for (k,ws) in connected_workers_by_key.items():
+    lines.append(f'  {len(workers_by_key)} keys:')
+    for (k,ws) in workers_by_key:
         avail_slots = 0
         max_slots = 0
         for w in ws:
-            avail_slots += w.avail_slots
+            avail_slots += w.free_slots()
             max_slots += w.desc.max_slots
-        try:
-            outstanding = len(job_queue_by_key[k])
-        except KeyError:
-            outstanding = 0
+        outstanding = g_matchmaker.num_jobs(k)
         lines.append(f'    slots: {avail_slots:.2f}/{max_slots}\toutstanding: {outstanding}\t{k}')
+
+    usage_by_host = g_fair_share.snapshot()
+    lines.append(f'  {len(usage_by_host)} hosts:')
+    for (host, usage) in sorted(usage_by_host.items(), key=lambda x: x[1]):
+        lines.append(f'    usage: {usage:.1f}s\t{host}')
     lines.append('')
     return '\n'.join(lines)
 
@@ -263,66 +372,51 @@ def th_stats():
                 g_stats_cv.wait()
             g_stats_cv.update_pending = False
 
-        with g_cvar:
-            s = stats()
-
-        logging.warning(s)
+        logging.warning(stats())
         time.sleep(0.3)
 
 threading.Thread(target=th_stats, daemon=True).start()
 
 # --
 
-def matchmake():
-    next_jobs = [x[0] for x in job_queue_by_key.values()]
-    next_jobs = sorted(next_jobs, key=lambda x: x.id)
-    for job in next_jobs:
-        try:
-            workers = available_workers_by_key[job.key]
-        except KeyError:
-            continue
-        assert len(workers)
-        weigts = (x.avail_slots for x in workers)
-        cum_weights = list(itertools.accumulate(weigts))
-        (worker,) = random.choices(workers, cum_weights=cum_weights, k=1)
-
-        job.set_active(False)
-        worker.set_active(False)
-
-        return (job, worker)
-
-    return (None, None)
+# Independent of queue depth. See matchmaking.Matchmaker.
+def matchmake(timeout=None):
+    (job, worker) = g_matchmaker.pop_match(timeout)
+    if job:
+        job.charges.append(g_fair_share.on_assigned(job.hostname, job.key))
+        job.on_matched()
+        worker.take_lease()
+    return (job, worker)
 
 
 def matchmake_loop():
     try:
-        with g_cvar:
-            while True:
+        while True:
+            (job, worker) = matchmake(timeout=0)
+            if not job:
+                '''
+                info = 'Outstanding jobs:'
+                keys = [k for k in g_matchmaker.keys() if g_matchmaker.num_jobs(k)]
+                if keys:
+                    info = '\n'.join([info] +
+                        ['  {}: {}'.format(k, g_matchmaker.num_jobs(k)) for k in keys])
+                else:
+                    info += ' None'
+                '''
+                stats_changed()
                 (job, worker) = matchmake()
-                if not job:
-                    '''
-                    info = 'Outstanding jobs:'
-                    if job_queue_by_key:
-                        info = '\n'.join([info] +
-                            ['  {}: {}'.format(k, len(v)) for (k,v) in job_queue_by_key.items()])
-                    else:
-                        info += ' None'
-                    '''
-                    stats_changed()
-                    g_cvar.wait()
-                    continue
-
-                logging.warning('Matched ({}, {})'.format(job, worker))
-
-                wap = WorkerAssignmentPacket()
-                wap.hostname = worker.desc.hostname
-                wap.addrs = worker.desc.addrs
-                try:
-                    job.pconn.send(wap.encode())
-                except OSError:
-                    logging.warning('Disconnect during matchmaking.')
-                    job.pconn.nuke()
-                    continue
+
+            logging.warning('Matched ({}, {})'.format(job, worker))
+
+            wap = WorkerAssignmentPacket()
+            wap.hostname = worker.desc.hostname
+            wap.addrs = worker.desc.addrs
+            try:
+                job.pconn.send(wap.encode())
+            except OSError:
+                logging.warning('Disconnect during matchmaking.')
+                job.pconn.nuke()
+                continue
     except Exception:
         traceback.print_exc()
     finally:
@@ -334,18 +428,27 @@ threading.Thread(target=matchmake_loop, daemon=True).start()
 
 # --
 
+def on_accept(pconn):
+    conn_type = yield
+
+    if conn_type == b'job':
+        yield from job_accept(pconn)
+        return
+    if conn_type == b'worker':
+        yield from worker_accept(pconn)
+        return
+    if conn_type == b'session': # From session_agent.py, on behalf of many local shims.
+        yield from nu.mux_packet_handler(pconn, on_accept)
+        return
+    assert False, conn_type
+
+
 def th_on_accept(conn, addr):
     try:
         pconn = nu.PacketConn(conn, CONFIG['KEEPALIVE_TIMEOUT'], True)
-        conn_type = pconn.recv()
     except OSError:
         return
-
-    if conn_type == b'job':
-        return job_accept(pconn)
-    if conn_type == b'worker':
-        return worker_accept(pconn)
-    assert False, conn_type
+    nu.drive_packet_handler(pconn, on_accept(pconn))
 
 # --
 
@@ -372,7 +475,7 @@ if not addr[0]:
         exit(1)
 
     logging.warning('Checking for pre-existing mDNS job_server...')
-    existing = job_server_addr(timeout=1.0)
+    existing = query_job_server_mdns(timeout=1.0) # Not the cache, which may be our own past self.
     if existing:
         logging.error('mDNS found existing job_server at %s. Aborting...', existing)
         exit(1)
@@ -397,7 +500,10 @@ if addr[0] == 'localhost':
     logging.error('Hosting job_server on localhost, which excludes remote hosts.')
 
 logging.warning('Hosting job_server at: {}'.format(addr))
-server = nu.Server([addr], target=th_on_accept)
+if CONFIG['EVENT_SERVER']:
+    server = nu.EventServer([addr], target=on_accept, timeout=CONFIG['KEEPALIVE_TIMEOUT'])
+else:
+    server = nu.Server([addr], target=th_on_accept)
 
 server.listen_until_shutdown()
 
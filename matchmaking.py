@@ -0,0 +1,517 @@
+#!/usr/bin/env python3
+assert __name__ != '__main__'
+
+import hashlib
+import heapq
+import random
+import threading
+import time
+
+# --
+
+# Prefix sums over a growable array of weights, with O(log n) updates and weighted search.
+class FenwickTree(object):
+    def __init__(self, weights):
+        self.n = len(weights)
+        self.tree = [0.0] + list(weights)
+        for i in range(1, self.n + 1):
+            parent = i + (i & -i)
+            if parent <= self.n:
+                self.tree[parent] += self.tree[i]
+
+
+    def add(self, i, delta):
+        i += 1
+        while i <= self.n:
+            self.tree[i] += delta
+            i += i & -i
+
+
+    def total(self):
+        ret = 0.0
+        i = self.n
+        while i:
+            ret += self.tree[i]
+            i -= i & -i
+        return ret
+
+
+    # Lowest index whose inclusive prefix sum exceeds `target`.
+    def find(self, target):
+        pos = 0
+        step = 1 << self.n.bit_length()
+        while step:
+            next_pos = pos + step
+            if next_pos <= self.n and self.tree[next_pos] <= target:
+                pos = next_pos
+                target -= self.tree[next_pos]
+            step >>= 1
+        return pos
+
+# -
+
+# Items with positive weights, for O(log n) weighted random picks.
+class WeightedSet(object):
+    def __init__(self):
+        self.items = []
+        self.weights = []
+        self.slot_by_item = {}
+        self.free_slots = []
+        self.tree = FenwickTree([])
+
+
+    def __len__(self):
+        return len(self.slot_by_item)
+
+
+    def __iter__(self):
+        return iter(self.slot_by_item)
+
+
+    def __contains__(self, item):
+        return item in self.slot_by_item
+
+
+    def weight(self, item):
+        return self.weights[self.slot_by_item[item]]
+
+
+    def set(self, item, weight):
+        if weight <= 0:
+            self.remove(item)
+            return
+
+        try:
+            slot = self.slot_by_item[item]
+        except KeyError:
+            if not self.free_slots:
+                self._grow()
+            slot = self.free_slots.pop()
+            self.slot_by_item[item] = slot
+            self.items[slot] = item
+
+        self.tree.add(slot, weight - self.weights[slot])
+        self.weights[slot] = weight
+
+
+    def remove(self, item):
+        try:
+            slot = self.slot_by_item.pop(item)
+        except KeyError:
+            return
+        self.tree.add(slot, -self.weights[slot])
+        self.weights[slot] = 0.0
+        self.items[slot] = None
+        self.free_slots.append(slot)
+
+
+    def _grow(self):
+        old_n = len(self.items)
+        new_n = max(8, old_n * 2)
+        self.items += [None] * (new_n - old_n)
+        self.weights += [0.0] * (new_n - old_n)
+        self.free_slots += reversed(range(old_n, new_n))
+        self._rebuild()
+
+
+    # Also sheds accumulated float error.
+    def _rebuild(self):
+        self.tree = FenwickTree(self.weights)
+
+
+    def pick(self, rand=random.random):
+        if not self.slot_by_item:
+            return None
+        for _ in range(2):
+            slot = self.tree.find(rand() * self.tree.total())
+            if slot < len(self.items) and self.items[slot] is not None:
+                return self.items[slot]
+            self._rebuild() # Drifted onto an empty slot.
+        return next(iter(self.slot_by_item))
+
+# --
+
+# Scheduling policies pick which of a key's available workers gets a job. `workers` is a
+# WeightedSet of workers (with `.hostname` and `.max_slots`) weighted by free slots. Jobs
+# have `.hostname` and `.affinity`. Policies run under the key's shard lock.
+
+class WeightedRandomPolicy(object):
+    def pick(self, job, workers):
+        return workers.pick()
+
+
+class PreferLocalPolicy(object):
+    def __init__(self, fallback):
+        self.fallback = fallback
+
+
+    def pick(self, job, workers):
+        local = [w for w in workers if w.hostname == job.hostname]
+        if local:
+            return max(local, key=workers.weight)
+        return self.fallback.pick(job, workers)
+
+
+# Highest fraction of slots free.
+class LeastLoadedPolicy(object):
+    def pick(self, job, workers):
+        return max(workers, key=lambda w: workers.weight(w) / max(w.max_slots, 1))
+
+
+# EWMA of client->worker connect times, as reported by clients.
+class RttTable(object):
+    ALPHA = 0.2
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rtt_by_hosts = {}
+
+
+    def add_sample(self, client_host, worker_host, secs):
+        k = (client_host, worker_host)
+        with self.lock:
+            try:
+                self.rtt_by_hosts[k] += self.ALPHA * (secs - self.rtt_by_hosts[k])
+            except KeyError:
+                self.rtt_by_hosts[k] = secs
+
+
+    def get(self, client_host, worker_host):
+        return self.rtt_by_hosts.get((client_host, worker_host))
+
+
+# Unmeasured pairs get picked first, so every link gets measured.
+class LowestRttPolicy(object):
+    def __init__(self, rtts):
+        self.rtts = rtts
+
+
+    def pick(self, job, workers):
+        def rtt(w):
+            ret = self.rtts.get(job.hostname, w.hostname)
+            if ret is None:
+                return -1.0
+            return ret
+        return min(workers, key=rtt)
+
+
+# Rendezvous hashing of the job's affinity token, so the same source lands on the same
+# worker (and its caches) whenever that worker has a free slot. Without a token, falls back.
+class CacheAffinityPolicy(object):
+    def __init__(self, fallback):
+        self.fallback = fallback
+
+
+    def pick(self, job, workers):
+        if not job.affinity:
+            return self.fallback.pick(job, workers)
+        def score(w):
+            return hashlib.sha256(job.affinity + w.hostname.encode()).digest()
+        return max(workers, key=score)
+
+
+def make_policy(name, rtts):
+    if name == 'weighted-random':
+        return WeightedRandomPolicy()
+    if name == 'prefer-local':
+        return PreferLocalPolicy(WeightedRandomPolicy())
+    if name == 'least-loaded':
+        return LeastLoadedPolicy()
+    if name == 'lowest-rtt':
+        return LowestRttPolicy(rtts)
+    if name == 'cache-affinity':
+        return CacheAffinityPolicy(WeightedRandomPolicy())
+    raise ValueError(name)
+
+# --
+
+# Decayed slot-seconds consumed minus contributed, per host. Hosts that used less of the
+# farm lately go first, so an interactive build isn't stuck behind someone's -j200, while
+# hosts that run workers (or were given karma) earn credit.
+class FairShare(object):
+    DEFAULT_ESTIMATE = 1.0 # Secs, for keys we haven't seen finish yet.
+    ESTIMATE_ALPHA = 0.1
+
+    def __init__(self, half_life):
+        self.half_life = half_life
+        self.lock = threading.Lock()
+        self.usage_by_host = {} # host -> (usage, as of time)
+        self.estimate_by_key = {}
+
+
+    def _add(self, host, amount, now):
+        assert self.lock.locked()
+        self.usage_by_host[host] = (self._usage(host, now) + amount, now)
+
+
+    def _usage(self, host, now):
+        try:
+            (usage, t) = self.usage_by_host[host]
+        except KeyError:
+            return 0.0
+        return usage * 0.5 ** ((now - t) / self.half_life)
+
+
+    def usage(self, host):
+        return self._usage(host, time.monotonic())
+
+
+    def estimate(self, key):
+        return self.estimate_by_key.get(key, self.DEFAULT_ESTIMATE)
+
+
+    # Charge up front, so a host can't grab every slot before its first job finishes.
+    # Returns the charge, for on_done to correct.
+    def on_assigned(self, host, key):
+        with self.lock:
+            charged = self.estimate(key)
+            self._add(host, charged, time.monotonic())
+        return charged
+
+
+    def on_done(self, host, worker_host, key, secs, charged):
+        now = time.monotonic()
+        with self.lock:
+            est = self.estimate(key)
+            self._add(host, secs - charged, now)
+            self._add(worker_host, -secs, now)
+            self.estimate_by_key[key] = est + self.ESTIMATE_ALPHA * (secs - est)
+
+
+    def add_karma(self, host, points):
+        with self.lock:
+            self._add(host, -points, time.monotonic())
+
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self.lock:
+            return {host: self._usage(host, now) for host in self.usage_by_host}
+
+# --
+
+# Within a host, higher `.priority` first, then higher `.cost` (longest-first, to shorten a
+# build's critical path), then FIFO.
+def job_order(job):
+    return (-job.priority, -job.cost, job.id)
+
+
+# One key's jobs and available workers, under its own lock. Jobs queue per host.
+class KeyShard(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queue_by_host = {} # Heaps of job_order()s, with lazy removal.
+        self.job_by_id = {}
+        self.order_by_id = {}
+        self.parked_by_id = {} # Jobs whose only available workers are on their `.exclude` host.
+        self.workers = WeightedSet()
+
+
+    def is_queued(self, order):
+        return self.order_by_id.get(order[-1]) == order
+
+
+    # `host`'s next job's job_order(), or None.
+    def head(self, host):
+        assert self.lock.locked()
+        try:
+            queue = self.queue_by_host[host]
+        except KeyError:
+            return None
+        while queue and not self.is_queued(queue[0]):
+            heapq.heappop(queue)
+        if not queue:
+            del self.queue_by_host[host]
+            return None
+        return queue[0]
+
+
+    def heads(self):
+        assert self.lock.locked()
+        ret = []
+        for host in list(self.queue_by_host):
+            order = self.head(host)
+            if order:
+                ret.append((host, order))
+        return ret
+
+
+    def queue(self, job):
+        assert self.lock.locked()
+        order = job_order(job)
+        self.order_by_id[job.id] = order
+        heapq.heappush(self.queue_by_host.setdefault(job.hostname, []), order)
+        return order
+
+
+    # Available workers `job` may go to.
+    def workers_for(self, job):
+        if not job.exclude:
+            return self.workers
+        ret = WeightedSet()
+        for w in self.workers:
+            if w.hostname != job.exclude:
+                ret.set(w, self.workers.weight(w))
+        return ret
+
+
+# Jobs (with `.id`, `.key`, `.hostname`, `.priority` and `.cost`) queue per key and host.
+# The next match is the job with the lowest (host usage, *job_order()) across keys with
+# available workers. Without a `fair_share`, that's priority, then longest-first, then FIFO.
+# Its worker is picked by `policy`, from those not on the job's `.exclude` host, if any.
+# A job with no such worker is parked until one becomes available.
+#
+# State is sharded per key, so arrivals and slot updates for one key don't contend with
+# another's. Each host's queued jobs that head their key's queue, in keys with available
+# workers, are in a heap for that host, with lazy removal. Finding the next job compares
+# each host's top, and there are few hosts.
+class Matchmaker(object):
+    def __init__(self, policy=None, fair_share=None):
+        self.policy = policy or WeightedRandomPolicy()
+        self.fair_share = fair_share
+        self.shards_lock = threading.Lock()
+        self.shard_by_key = {}
+        self.ready_cv = threading.Condition(threading.Lock())
+        self.ready_by_host = {} # Heaps of (job_order(), key).
+
+
+    def shard(self, key):
+        try:
+            return self.shard_by_key[key]
+        except KeyError:
+            pass
+        with self.shards_lock:
+            return self.shard_by_key.setdefault(key, KeyShard())
+
+
+    def keys(self):
+        return list(self.shard_by_key)
+
+
+    def _push_ready(self, key, heads):
+        if not heads:
+            return
+        with self.ready_cv:
+            for (host, order) in heads:
+                heapq.heappush(self.ready_by_host.setdefault(host, []), (order, key))
+            self.ready_cv.notify()
+
+
+    # After a change to `host`'s jobs, its head may be new.
+    def _host_heads(self, shard, host):
+        if not shard.workers:
+            return []
+        order = shard.head(host)
+        if not order:
+            return []
+        return [(host, order)]
+
+
+    def add_job(self, job):
+        shard = self.shard(job.key)
+        with shard.lock:
+            shard.job_by_id[job.id] = job
+            order = shard.queue(job)
+            heads = []
+            if shard.head(job.hostname) == order:
+                heads = self._host_heads(shard, job.hostname)
+        self._push_ready(job.key, heads)
+
+
+    # After `job`'s order changed. No-op if it isn't queued.
+    def reorder_job(self, job):
+        shard = self.shard(job.key)
+        with shard.lock:
+            if job.id not in shard.job_by_id or job.id in shard.parked_by_id:
+                return # Parked jobs are reordered as they're unparked.
+            shard.queue(job)
+            heads = self._host_heads(shard, job.hostname)
+        self._push_ready(job.key, heads)
+
+
+    def remove_job(self, job):
+        shard = self.shard(job.key)
+        with shard.lock:
+            if shard.job_by_id.pop(job.id, None) is None:
+                return
+            shard.order_by_id.pop(job.id, None)
+            shard.parked_by_id.pop(job.id, None)
+            heads = self._host_heads(shard, job.hostname)
+        self._push_ready(job.key, heads)
+
+
+    def num_jobs(self, key):
+        return len(self.shard(key).job_by_id)
+
+
+    def jobs(self, key):
+        shard = self.shard(key)
+        with shard.lock:
+            return list(shard.job_by_id.values())
+
+
+    # `weight` <= 0 makes `worker` unavailable for `key`.
+    def set_worker(self, worker, key, weight):
+        shard = self.shard(key)
+        with shard.lock:
+            was_ready = bool(shard.workers)
+            shard.workers.set(worker, weight)
+            unparked = []
+            if weight > 0:
+                unparked = [j for j in shard.parked_by_id.values()
+                            if j.exclude != worker.hostname]
+            for job in unparked:
+                del shard.parked_by_id[job.id]
+                shard.queue(job)
+            heads = []
+            if shard.workers and (unparked or not was_ready):
+                heads = shard.heads() # Unparked, or dropped while we had no workers.
+        self._push_ready(key, heads)
+
+
+    # Returns (job, worker), with the job removed, or (None, None) on timeout.
+    def pop_match(self, timeout=None):
+        with self.ready_cv:
+            while True:
+                best = None
+                idle_hosts = []
+                for (host, ready) in self.ready_by_host.items():
+                    # Unlocked peeks, which the pop below rechecks under the shard's lock.
+                    while ready:
+                        (order, key) = ready[0]
+                        shard = self.shard_by_key[key]
+                        if shard.workers and shard.order_by_id.get(order[-1]) == order:
+                            break
+                        heapq.heappop(ready)
+                    if not ready:
+                        idle_hosts.append(host)
+                        continue
+                    if self.fair_share:
+                        order = (self.fair_share.usage(host), order)
+                    if not best or order < best[0]:
+                        best = (order, host)
+                for host in idle_hosts:
+                    del self.ready_by_host[host]
+
+                if not best:
+                    if not self.ready_cv.wait(timeout):
+                        return (None, None)
+                    continue
+
+                (order, key) = heapq.heappop(self.ready_by_host[best[1]])
+                shard = self.shard_by_key[key]
+                with shard.lock:
+                    if not (shard.workers and shard.is_queued(order)):
+                        continue # Changed meanwhile.
+                    job = shard.job_by_id[order[-1]]
+                    del shard.order_by_id[job.id]
+                    workers = shard.workers_for(job)
+                    if workers:
+                        del shard.job_by_id[job.id]
+                        worker = self.policy.pick(job, workers)
+                    else:
+                        shard.parked_by_id[job.id] = job
+                    for (host, order) in self._host_heads(shard, job.hostname):
+                        heapq.heappush(self.ready_by_host.setdefault(host, []), (order, key))
+                if workers:
+                    return (job, worker)
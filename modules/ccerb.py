@@ -1,30 +1,30 @@
 #!/usr/bin/env python3
 assert __name__ != '__main__'
 
-import lzma
+import atexit
+import collections
+import hashlib
+import importlib.util
+import itertools
+import json
+import marshal
+import math
 import os
 import pathlib
+import random
 import re
 import shutil
+import signal
 import socket
-import subprocess
+import struct
 import sys
-import tempfile
+import traceback
 import threading
 import time
 import zlib
 
 from common import *
 
-# --
-
-COMPRESS_ZLIB_LEVEL = 0
-COMPRESS_LZMA = False
-
-COMPRESS_ZLIB_LEVEL = 1 # ~115Mbps compressing
-#COMPRESS_ZLIB_LEVEL = 6 # ~35Mbps compressing
-#COMPRESS_LZMA = True # ~2Mbps compressing
-
 # --
 '''
 $ clang --version
@@ -54,7 +54,8 @@ usage: cl [ option... ] filename... [ /link linkoption... ]
 RE_PARENS = re.compile(b'[(][^)]+[)]')
 RE_VERSION = re.compile(b'[0-9][.0-9]+')
 
-def get_cc_key(path):
+def query_cc_key(path):
+    import subprocess # Once per cc, so shims that dispatch without spawning don't pay for it.
     p = subprocess.run([path, '--version'], capture_output=True)
     if p.stderr:
         spew = p.stderr # cl
@@ -78,6 +79,66 @@ def get_cc_key(path):
     #logging.info('{} -> {}'.format(path, key))
     return key
 
+
+# query_cc_key's results by resolved path, revalidated by stat, and persisted in ~/.pydra,
+# since every shim needs its compiler's key, and workers re-list theirs every second.
+# (A wrapper script is keyed on itself, not whatever it runs.)
+class CcKeyCache(object):
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.lock = threading.Lock()
+        self.recs = None # Read on first use.
+
+
+    def _load(self):
+        assert self.lock.locked()
+        if self.recs is not None:
+            return
+        self.recs = {}
+        try:
+            self.recs = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            pass
+
+
+    def save(self):
+        with self.lock:
+            if self.recs is None:
+                return # Unused, so unchanged.
+            text = json.dumps(self.recs)
+        temp_path = temp_path_for(self.path)
+        try:
+            temp_path.write_text(text)
+            os.replace(temp_path, self.path)
+        except OSError:
+            pass
+
+
+    def get(self, path):
+        resolved = shutil.which(path)
+        if not resolved:
+            raise FileNotFoundError(path)
+        resolved = os.path.realpath(resolved)
+        st = os.stat(resolved)
+        stamp = [st.st_mtime_ns, st.st_size, st.st_ino]
+        with self.lock:
+            self._load()
+            rec = self.recs.get(resolved)
+        if rec and rec[:3] == stamp:
+            return bytes.fromhex(rec[3])
+
+        key = query_cc_key(path)
+        with self.lock:
+            self.recs[resolved] = stamp + [key.hex()]
+        self.save()
+        return key
+
+
+CC_KEY_CACHE = CcKeyCache(PYDRA_HOME / 'ccerb_cc_keys.json')
+
+def get_cc_key(path):
+    return CC_KEY_CACHE.get(path)
+
 # --
 
 class ExShimOut(Exception):
@@ -98,6 +159,7 @@ def extract_cc_preproc_args(cc_args):
         raise ExShimOut('no cc_args')
 
     source_file_name = None
+    source_path = None
     is_compile_only = False
 
     preproc = ['-E']
@@ -189,6 +251,7 @@ def extract_cc_preproc_args(cc_args):
                 raise ExShimOut('TODO: multiple source files', logging.warning)
 
             source_file_name = os.path.basename(cur)
+            source_path = cur
             preproc.append(cur)
             compile.append(source_file_name)
             continue
@@ -204,7 +267,7 @@ def extract_cc_preproc_args(cc_args):
     if not source_file_name:
         raise ExShimOut('no source file detected', logging.warning)
 
-    return (preproc, compile, source_file_name)
+    return (preproc, compile, source_file_name, source_path)
 
 ####
 '''
@@ -297,33 +360,242 @@ def pydra_get_subkeys():
 
 # -
 
-def write_files_and_discard(root_dir, files):
-    root_dir = pathlib.Path(root_dir)
-    paths = [root_dir / rel_path for (rel_path, data) in files]
-    for (path, rp_and_data) in zip(paths, files):
-        parent = pathlib.Path(path.parent)
-        parent.mkdir(parents=True, exist_ok=True)
-        path.write_bytes(rp_and_data[1])
-        logging.debug('<wrote %s (%i bytes)>', path, len(rp_and_data[1]))
-        rp_and_data[1] = None # Discard.
-    assert not files or not files[0][1]
-    return paths
-
-
-def read_files(root_dir):
+def list_files(root_dir):
     root_dir = pathlib.Path(root_dir)
     ret = []
     for path in root_dir.rglob('*'):
         if path.is_dir():
             continue
-
-        data = path.read_bytes()
-        logging.debug('<read {} ({} bytes)>'.format(path, len(data)))
-
         rel_path = str(path.relative_to(root_dir))
-        ret.append([rel_path, data])
+        ret.append([rel_path, path])
     return ret
 
+
+def write_chunks(path, chunks):
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    size = 0
+    with path.open('wb') as f:
+        for x in chunks:
+            f.write(x)
+            size += len(x)
+    logging.debug('<wrote %s (%i bytes)>', path, size)
+    return size
+
+# -
+
+try:
+    CACHE_MAX_BYTES = CONFIG['CCERB_CACHE_MAX_BYTES']
+except KeyError:
+    CACHE_MAX_BYTES = 2 * 1000 * 1000 * 1000 # 0 disables.
+
+
+def cache_hasher(cc_key, compile_args):
+    bw = ByteWriter()
+    bw.pack_bytes(cc_key)
+    bw.pack_t(U16_T, len(compile_args))
+    [bw.pack_bytes(x.encode()) for x in compile_args]
+    return hashlib.sha256(bw.data())
+
+
+def cache_digest(cc_key, compile_args, preproc_data):
+    h = cache_hasher(cc_key, compile_args)
+    h.update(preproc_data)
+    return h.digest()
+
+
+# Entries are a header, then the raw bytes of each output file, so neither
+# storing nor replaying them needs whole files in memory.
+class CacheEntry(object):
+    def __init__(self, f):
+        self.f = f
+        (header_len,) = U64_T.unpack(f.read(U64_T.size))
+        br = ByteReader(f.read(header_len))
+        self.retcode = br.unpack_t(I32_T)
+        self.stdout = br.unpack_bytes()
+        self.stderr = br.unpack_bytes()
+        num_files = br.unpack_t(U32_T)
+        self.files = []
+        for _ in range(num_files):
+            name = br.unpack_bytes().decode()
+            self.files.append((name, br.unpack_t(U64_T)))
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, ex_type, ex_val, ex_traceback):
+        self.f.close()
+
+
+    # Yields (name, chunks) in order. Each `chunks` must be consumed before the next.
+    def iter_files(self):
+        for (name, size) in self.files:
+            yield (name, self._read_chunks(size))
+
+
+    def _read_chunks(self, size):
+        while size:
+            b = self.f.read(min(size, nu.STREAM_CHUNK_SIZE))
+            if not b:
+                raise EOFError(self.f.name)
+            size -= len(b)
+            yield b
+
+
+    def extract(self, root_dir):
+        root_dir = pathlib.Path(root_dir)
+        for (name, chunks) in self.iter_files():
+            write_chunks(root_dir / name, chunks)
+
+
+    @staticmethod
+    def write(f, retcode, stdout, stderr, output_paths):
+        sizes = [pathlib.Path(path).stat().st_size for (_, path) in output_paths]
+
+        bw = ByteWriter()
+        bw.pack_t(I32_T, retcode)
+        bw.pack_bytes(stdout)
+        bw.pack_bytes(stderr)
+        bw.pack_t(U32_T, len(output_paths))
+        for ((name, _), size) in zip(output_paths, sizes):
+            bw.pack_bytes(name.encode())
+            bw.pack_t(U64_T, size)
+        header = bw.data()
+
+        f.write(nu.pack_t(U64_T, len(header)))
+        f.write(header)
+        for (_, path) in output_paths:
+            with open(path, 'rb') as src:
+                shutil.copyfileobj(src, f)
+
+
+class ResultCache(object):
+    def __init__(self, root, max_bytes):
+        self.root = pathlib.Path(root)
+        self.max_bytes = max_bytes
+
+
+    def _path(self, digest):
+        return self.root / digest.hex()
+
+
+    def get(self, digest):
+        if not self.max_bytes:
+            return None
+        path = self._path(digest)
+        try:
+            f = path.open('rb')
+        except OSError:
+            return None
+        try:
+            os.utime(path) # Bump mtime, which is our LRU order.
+            return CacheEntry(f)
+        except (OSError, EOFError, ValueError, struct.error):
+            f.close()
+            return None
+
+
+    def put(self, digest, retcode, stdout, stderr, output_paths):
+        if not self.max_bytes:
+            return
+        path = self._path(digest)
+        temp_path = temp_path_for(path)
+        try:
+            self.root.mkdir(parents=True, exist_ok=True)
+            with temp_path.open('wb') as f:
+                CacheEntry.write(f, retcode, stdout, stderr, output_paths)
+                entry_bytes = f.tell()
+            os.replace(temp_path, path) # Atomic, so concurrent shims never see partial entries.
+        except OSError:
+            logging.warning('Failed to write cache entry: %s', path)
+            try:
+                temp_path.unlink()
+            except OSError:
+                pass
+            return
+        maybe_evict_lru(self.root, self.max_bytes, entry_bytes)
+
+
+EVICT_EVERY_FRACTION = 1 / 64 # Of max_bytes written, since a scan isn't free.
+
+# Shims each write once, so they can't count bytes written between scans like BlobStore.
+# Instead, each write scans with the odds that make scans just as rare on average.
+def maybe_evict_lru(root, max_bytes, new_bytes):
+    if random.random() * max_bytes * EVICT_EVERY_FRACTION < new_bytes:
+        evict_lru(root, max_bytes)
+
+
+EVICT_TEMP_GRACE_SECS = 60.0 # Temp files this fresh are probably still being written.
+
+# Oldest-mtime-first, until the files in `root` fit in `max_bytes`.
+def evict_lru(root, max_bytes):
+    entries = []
+    total_bytes = 0
+    now = time.time()
+    with os.scandir(root) as it:
+        for x in it:
+            try:
+                st = x.stat()
+            except OSError:
+                continue
+            if '.tmp' in x.name and now - st.st_mtime < EVICT_TEMP_GRACE_SECS:
+                continue # Someone's put(). Older ones were left by crashes, so they go.
+            entries.append((st.st_mtime, st.st_size, x.path))
+            total_bytes += st.st_size
+
+    if total_bytes <= max_bytes:
+        return
+    entries.sort()
+    for (_, size, path) in entries:
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass # Someone else got it.
+        total_bytes -= size
+
+
+try:
+    WORKER_CACHE_MAX_BYTES = CONFIG['CCERB_WORKER_CACHE_MAX_BYTES']
+except KeyError:
+    WORKER_CACHE_MAX_BYTES = 10 * 1000 * 1000 * 1000 # 0 disables.
+
+RESULT_CACHE = ResultCache(PYDRA_HOME / 'ccerb_cache', CACHE_MAX_BYTES)
+WORKER_CACHE = ResultCache(PYDRA_HOME / 'ccerb_worker_cache', WORKER_CACHE_MAX_BYTES)
+
+# -
+
+output_temp_counter = itertools.count()
+
+# Outputs stream into temp files beside their destination, and are only moved into
+# place once the whole job succeeded.
+def output_temp_path(name):
+    return pathlib.Path('{}.pydra-{}-{}'.format(name, os.getpid(), next(output_temp_counter)))
+
+
+def discard_outputs(output_files):
+    for (_, temp_path) in output_files:
+        try:
+            temp_path.unlink()
+        except OSError:
+            pass
+
+
+def commit_outputs(output_files):
+    for (name, temp_path) in output_files:
+        if name.endswith('.pdb'):
+            assert not pathlib.Path(name).exists()
+        os.replace(temp_path, name)
+
+
+def write_std(stdout_prefix, stdout, stderr):
+    sys.stdout.buffer.write(stdout_prefix)
+    sys.stdout.buffer.write(stdout)
+    sys.stderr.buffer.write(stderr)
+
 # -
 
 def pydra_shim(pydra_iface, *mod_args):
@@ -345,13 +617,19 @@ def pydra_shim(pydra_iface, *mod_args):
 
         # -
 
-        (preproc_args, compile_args, source_file_name) = extract_cc_preproc_args(cc_args)
+        (preproc_args, compile_args, source_file_name, source_path) = \
+                extract_cc_preproc_args(cc_args)
 
         logging.info('  {}: ({}) Preproc...'.format(source_file_name, t.time()))
         logging.debug('    {}: mod_args: {}'.format(source_file_name, preproc_args))
         logging.debug('    {}: preproc_args: {}'.format(source_file_name, preproc_args))
         logging.debug('    {}: compile_args: {}'.format(source_file_name, compile_args))
 
+        # Workers compile preprocessed source, which has no deps to write. (-MD would also
+        # want our dirs.)
+        output = output_name(cc_bin, compile_args, source_file_name)
+        (compile_args, _) = split_dep_args(cc_bin, compile_args, output)
+
         has_show_includes = '-showIncludes' in preproc_args
         if has_show_includes:
             preproc_args.append('-nologo')
@@ -365,53 +643,97 @@ def pydra_shim(pydra_iface, *mod_args):
 
         # -
 
-        p = subprocess.run([cc_bin] + preproc_args, capture_output=True)
-        if p.returncode != 0:
-            raise ExShimOut('preproc failed', logging.info) # Safer to shim out.
-        preproc_data = p.stdout
-        preproc_time = t.time()
-        logging.info('  {}: ({}) Preproc complete. ({} bytes) Dispatch...'.format(source_file_name,
-                preproc_time, len(preproc_data)))
-
         stdout_prefix = b''
-        if has_show_includes:
-            stdout_prefix = p.stderr
-
-        # Compress in shim, not client.
-        preproc_data = compress(preproc_data, source_file_name)
+        dep_file = None # Local preprocessing writes its own.
+        if REMOTE_PREPROC:
+            (preproc_args, dep_file) = split_dep_args(cc_bin, preproc_args, output)
+            remote = RemoteInputs(cc_bin, cc_key, preproc_args, source_path)
+            preproc_data = None
+            preproc_time = t.time()
+            logging.info('  {}: ({}) Include set {}. ({} files) Dispatch...'.format(
+                    source_file_name, preproc_time, 'scanned' if remote.scanned else 'reused',
+                    len(remote.files)))
+
+            digest = remote.digest(cc_key, compile_args)
+        else:
+            import subprocess
+            remote = None
+            p = subprocess.run([cc_bin] + preproc_args, capture_output=True)
+            if p.returncode != 0:
+                raise ExShimOut('preproc failed', logging.info) # Safer to shim out.
+            preproc_data = p.stdout
+            preproc_time = t.time()
+            logging.info('  {}: ({}) Preproc complete. ({} bytes) Dispatch...'.format(
+                    source_file_name, preproc_time, len(preproc_data)))
+
+            if has_show_includes:
+                stdout_prefix = p.stderr
+
+            digest = cache_digest(cc_key, compile_args, preproc_data)
+        cached = RESULT_CACHE.get(digest)
+        if cached:
+            job.server_pconn.nuke() # Never dispatched.
+            with cached:
+                for (name, _) in cached.files:
+                    if name.endswith('.pdb'):
+                        assert not pathlib.Path(name).exists()
+                cached.extract(os.getcwd())
+            if dep_file and cached.retcode == 0:
+                dep_file.write([path for (path, _) in remote.files])
+            logging.warning('Client: %s: (%s) Cache hit.', source_file_name, t.time())
+            write_std(stdout_prefix, cached.stdout, cached.stderr)
+            exit(cached.retcode)
 
         # -
 
         try:
+            # Same TU, same worker, if it's free: Its caches probably have what we need.
+            job.set_affinity(os.path.abspath(source_path).encode())
+            cost = remote.total_bytes if remote else len(preproc_data)
+            # Biggest TUs first, so they don't land last and stretch the build's tail.
+            job.set_hints(cost=float(cost))
+            deadline = None
+            if SPECULATE:
+                deadline = COMPILE_TIMES.deadline(cost)
             while True:
-                ret = job.dispatch(compile_args, source_file_name, preproc_data)
+                if deadline:
+                    ret = job.dispatch_speculative(deadline, compile_args, source_file_name,
+                            digest, preproc_data, remote,
+                            fn_discard=lambda x: discard_outputs(x[3]))
+                    deadline = None # Retry plainly. See dispatch_speculative on reusing jobs.
+                else:
+                    ret = job.dispatch(compile_args, source_file_name, digest, preproc_data,
+                                       remote)
                 if ret:
                     break
+            if remote:
+                digest = remote.digest(cc_key, compile_args) # In case it rescanned.
+            if SPECULATE:
+                COMPILE_TIMES.add_sample(cost, float(ret[4].time()) / 1000.0)
         except OSError:
             raise ExShimOut('Server disconnected:\n' + traceback.format_exc(), logging.warning)
         finally:
             job.server_pconn.nuke() # Done.
 
+        if preproc_data:
+            DICT_STORE.add_sample(preproc_data)
         preproc_data = None # Discard.
 
         # -
 
         (retcode, stdout, stderr, output_files, client_timer, compile_time) = ret
-        total_bytes = sum([len(x) for (_,x) in output_files])
+        total_bytes = sum([temp_path.stat().st_size for (_,temp_path) in output_files])
         logging.info('  {}: ({}/{}) Dispatch complete. ({} bytes, {} files) Writing...'.format(
                 source_file_name, compile_time, t.time(), total_bytes, len(output_files)))
 
-        # -
-
-        for (name,_) in output_files:
-            if name.endswith('.pdb'):
-                assert not pathlib.Path(name).exists()
+        commit_outputs(output_files)
+        if dep_file and retcode == 0:
+            dep_file.write([path for (path, _) in remote.files])
+        if retcode == 0:
+            RESULT_CACHE.put(digest, retcode, stdout, stderr,
+                             [(name, name) for (name, _) in output_files])
 
-        write_files_and_discard(os.getcwd(), output_files)
-
-        sys.stdout.buffer.write(stdout_prefix)
-        sys.stdout.buffer.write(stdout)
-        sys.stderr.buffer.write(stderr)
+        write_std(stdout_prefix, stdout, stderr)
 
         # -
 
@@ -429,20 +751,27 @@ def pydra_shim(pydra_iface, *mod_args):
         logging.warning('Client: %s: (%s w/ %s=%i%% overhead, %s=%i%% preproc) Complete.',
                 source_file_name, active_time, overhead, overhead_p, preproc_time,
                 preproc_p)
+
+        DICT_STORE.maybe_train() # After our outputs are written, at least.
         exit(retcode)
     except ExShimOut as e:
         e.log(mod_args)
+        import subprocess
         p = subprocess.run(mod_args)
         exit(p.returncode)
 
 # -
 
 class ScopedTempDir:
-    def __init__(self):
+    def __init__(self, parent=None):
+        self.parent = parent
         return
 
     def __enter__(self):
-        self.path = tempfile.mkdtemp()
+        import tempfile # Workers only.
+        if self.parent:
+            os.makedirs(self.parent, exist_ok=True)
+        self.path = tempfile.mkdtemp(dir=self.parent)
         return self
 
     def __exit__(self, ex_type, ex_val, ex_traceback):
@@ -451,110 +780,1463 @@ class ScopedTempDir:
 
 # -
 
-def run_in_temp_dir(input_files, args):
-    with ScopedTempDir() as temp_dir:
-        written_paths = write_files_and_discard(temp_dir.path, input_files)
+# Workers' per-job temp dirs, reused rather than created and removed for each job, and on
+# tmpfs where there is one, so small TUs' outputs never touch a disk.
+
+try:
+    SCRATCH_ROOT = CONFIG['CCERB_SCRATCH_ROOT']
+except KeyError:
+    SCRATCH_ROOT = '/dev/shm' if os.path.isdir('/dev/shm') else None # Else the system's.
+
+
+class ScratchDirs(object):
+    def __init__(self, root, max_idle):
+        self.root = root
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.parent = None
+        self.idle = []
+
+
+    def acquire(self):
+        import tempfile # Workers only.
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+            if not self.parent:
+                try:
+                    if self.root:
+                        os.makedirs(self.root, exist_ok=True)
+                    self.parent = tempfile.mkdtemp(prefix='pydra-ccerb-', dir=self.root)
+                except OSError:
+                    self.parent = tempfile.mkdtemp(prefix='pydra-ccerb-')
+                atexit.register(shutil.rmtree, self.parent, True)
+        return tempfile.mkdtemp(dir=self.parent)
+
+
+    def release(self, path):
+        try:
+            for x in os.scandir(path):
+                if x.is_dir(follow_symlinks=False):
+                    shutil.rmtree(x.path)
+                else:
+                    os.unlink(x.path)
+        except OSError:
+            shutil.rmtree(path, True)
+            return
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(path)
+                return
+        os.rmdir(path)
+
+
+SCRATCH_DIRS = ScratchDirs(SCRATCH_ROOT, CONFIG['WORKERS'])
+
+
+# Like ScopedTempDir, from a ScratchDirs pool.
+class ScratchDir:
+    def __init__(self, dirs=SCRATCH_DIRS):
+        self.dirs = dirs
+
+    def __enter__(self):
+        self.path = self.dirs.acquire()
+        return self
+
+    def __exit__(self, ex_type, ex_val, ex_traceback):
+        self.dirs.release(self.path)
+        return
+
+# -
+
+# Once a worker has everything it needs from the client, anything more from the client
+# (or its disconnect) is a cancel: Kill the compiler, and free the slot right away rather
+# than when it would've finished.
+class CancelWatch(object):
+    def __init__(self, pconn):
+        self.pconn = pconn
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.proc = None
+        self.started = False
+
+
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+        threading.Thread(target=self._th_watch, daemon=True).start()
+
+
+    def _th_watch(self):
+        try:
+            self.pconn.recv()
+        except OSError:
+            pass
+        with self.lock:
+            self.cancelled = True
+            if self.proc and self.proc.poll() is None:
+                logging.info('  <cancelled: killing %s>', self.proc.pid)
+                kill_tree(self.proc)
+
+
+    def set_proc(self, p):
+        with self.lock:
+            self.proc = p
+            if p and self.cancelled:
+                kill_tree(p)
+
+
+    def check(self):
+        if self.cancelled:
+            raise ConnectionAbortedError('Cancelled by client.')
+
+# -
+
+# Launchers are small helper processes, spawned ahead of time and reniced once, that spawn
+# compilers for us. The compilers inherit the lower priority from the start, instead of
+# each being reniced after it's already running, and spawning and waiting stay out of the
+# worker process. One job at a time each. They report each compiler's pid as it starts, so
+# a cancel can kill the compiler itself, not just its launcher.
+
+try:
+    USE_LAUNCHERS = CONFIG['CCERB_LAUNCHERS']
+except KeyError:
+    USE_LAUNCHERS = True
+
+LAUNCHER_CODE = '''
+import marshal, subprocess, sys
+(r, w) = (sys.stdin.buffer, sys.stdout.buffer)
+while True:
+    try:
+        (args, cwd, env) = marshal.load(r)
+    except EOFError:
+        break
+    p = subprocess.Popen(args, cwd=cwd, env=env, stdin=subprocess.DEVNULL,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    marshal.dump(p.pid, w)
+    w.flush()
+    (stdout, stderr) = p.communicate()
+    marshal.dump((p.returncode, stdout, stderr), w)
+    w.flush()
+'''
+
+
+# A launcher's compiler, for CancelWatch. It isn't our child, so there's nothing to wait on,
+# but once it's killed, its launcher reports back as usual.
+class LaunchedProc(object):
+    def __init__(self, pid):
+        self.pid = pid
+
+
+    def poll(self):
+        return None # Running until the launcher reports, when CancelWatch drops us.
+
+
+    def kill(self):
+        try:
+            os.kill(self.pid, getattr(signal, 'SIGKILL', signal.SIGTERM))
+        except OSError:
+            pass
+
 
-        logging.debug('<<running: {}>>'.format(args))
-        t = MsTimer()
-        p = subprocess.Popen(args, cwd=temp_dir.path, stdout=subprocess.PIPE,
+class Launcher(object):
+    def __init__(self):
+        import subprocess # Workers only.
+        self.p = subprocess.Popen([sys.executable, '-c', LAUNCHER_CODE],
+                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        nice_down(self.p.pid)
+
+
+    # Raises EOFError if we were killed. `on_spawn` gets the compiler's LaunchedProc.
+    def run(self, args, cwd, env, on_spawn=None):
+        marshal.dump((args, cwd, env), self.p.stdin)
+        self.p.stdin.flush()
+        pid = marshal.load(self.p.stdout)
+        if on_spawn:
+            on_spawn(LaunchedProc(pid))
+        return marshal.load(self.p.stdout)
+
+
+    def kill(self):
+        self.p.kill()
+        self.p.wait()
+
+
+# One launcher per slot, spawned in the background, and respawned when killed.
+class LauncherPool(object):
+    def __init__(self, size):
+        self.size = size
+        self.cv = threading.Condition(threading.Lock())
+        self.idle = []
+        self.count = 0 # Idle or busy.
+        self.spawner = None
+
+
+    def acquire(self):
+        with self.cv:
+            if not self.spawner:
+                self.spawner = threading.Thread(target=self._th_spawn, daemon=True)
+                self.spawner.start()
+            while not self.idle:
+                self.cv.wait()
+            return self.idle.pop()
+
+
+    def release(self, launcher):
+        with self.cv:
+            if launcher.p.poll() is None:
+                self.idle.append(launcher)
+            else:
+                self.count -= 1
+            self.cv.notify_all()
+
+
+    def _th_spawn(self):
+        while True:
+            with self.cv:
+                while self.count >= self.size:
+                    self.cv.wait()
+                self.count += 1
+            try:
+                launcher = Launcher()
+            except OSError:
+                logging.exception('Failed to spawn launcher.')
+                with self.cv:
+                    self.count -= 1
+                time.sleep(1.0)
+                continue
+            with self.cv:
+                self.idle.append(launcher)
+                self.cv.notify_all()
+
+
+LAUNCHERS = LauncherPool(CONFIG['WORKERS'])
+
+# -
+
+def run_compiler(cwd, args, env=None, cancel=None):
+    logging.debug('<<running: {}>>'.format(args))
+    t = MsTimer()
+    launcher = None
+    if USE_LAUNCHERS:
+        launcher = LAUNCHERS.acquire()
+    else:
+        import subprocess # Workers only.
+        p = subprocess.Popen(args, cwd=cwd, env=env, stdout=subprocess.PIPE,
                              stderr=subprocess.PIPE)
         nice_down(p.pid)
-        (stdout, stderr) = p.communicate()
-        compile_time = t.time()
+        if cancel:
+            cancel.set_proc(p)
+    retcode = None
+    try:
+        if launcher:
+            on_spawn = cancel.set_proc if cancel else None
+            (retcode, stdout, stderr) = launcher.run(args, cwd, env, on_spawn)
+        else:
+            (stdout, stderr) = p.communicate()
+            retcode = p.returncode
+    except (EOFError, OSError):
+        pass # Launcher killed.
+    finally:
+        if cancel:
+            cancel.set_proc(None)
+        if launcher:
+            if retcode is None:
+                launcher.kill() # Don't pool it half-killed.
+            LAUNCHERS.release(launcher)
+    compile_time = t.time()
+    if cancel:
+        cancel.check()
+    if retcode is None:
+        raise ChildProcessError('Launcher died: {}'.format(args))
+
+    return (retcode, stdout, stderr, compile_time)
 
-        for path in written_paths:
-            path.unlink()
+# -
 
-        output_files = read_files(temp_dir.path)
+SPEW_COMPRESSION_INFO = True
 
-    return (p.returncode, stdout, stderr, output_files, compile_time)
+class ChunkTransform(object):
+    def __init__(self, stages):
+        self.stages = stages # [(fn_process, fn_flush)]
+        self.in_size = 0
+        self.out_size = 0
+        self.secs = 0.0
+
+
+    def process(self, chunks):
+        for x in chunks:
+            self.in_size += len(x)
+            x = self._run(x, False)
+            if x:
+                yield x
+        x = self._run(b'', True)
+        if x:
+            yield x
+
+
+    def _run(self, x, flush):
+        start = time.time()
+        for (fn_process, fn_flush) in self.stages:
+            if len(x):
+                x = fn_process(x)
+            if flush:
+                x += fn_flush()
+        self.secs += time.time() - start
+        self.out_size += len(x)
+        return x
 
 # -
 
-SPEW_COMPRESSION_INFO = True
+class Codec(object):
+    def __init__(self, name, fn_compressor, fn_decompressor, mbps, ratio, supports_dict=False):
+        self.name = name
+        self.fn_compressor = fn_compressor # (zdict) -> compressobj
+        self.fn_decompressor = fn_decompressor # (zdict) -> decompressobj
+        self.prior = (mbps, ratio) # (MB/s in, out/in) until we've measured our own.
+        self.supports_dict = supports_dict
+
+
+    def compress_stages(self, zdict=None):
+        if not self.fn_compressor:
+            return []
+        o = self.fn_compressor(zdict)
+        return [(o.compress, o.flush)]
+
+
+    def decompress_stages(self, zdict=None):
+        if not self.fn_decompressor:
+            return []
+        o = self.fn_decompressor(zdict)
+        fn_flush = getattr(o, 'flush', lambda: b'') # lzma has no flush().
+        return [(o.decompress, fn_flush)]
+
+
+CODECS = {}
+
+def register_codec(codec):
+    CODECS[codec.name] = codec
+
+
+def zlib_compressor(level):
+    def fn(zdict):
+        if zdict:
+            return zlib.compressobj(level=level, zdict=zdict)
+        return zlib.compressobj(level=level)
+    return fn
+
+
+def zlib_decompressor(zdict):
+    if zdict:
+        return zlib.decompressobj(zdict=zdict)
+    return zlib.decompressobj()
+
+
+# Imported on use, since it's rarely picked, and shims start often.
+def lzma_compressor(zdict):
+    import lzma
+    return lzma.LZMACompressor()
+
+
+def lzma_decompressor(zdict):
+    import lzma
+    return lzma.LZMADecompressor()
+
+
+register_codec(Codec('none', None, None, float('inf'), 1.0))
+register_codec(Codec('zlib-1', zlib_compressor(1), zlib_decompressor, 60.0, 0.25, True))
+register_codec(Codec('zlib-6', zlib_compressor(6), zlib_decompressor, 20.0, 0.20, True))
+register_codec(Codec('lzma', lzma_compressor, lzma_decompressor, 2.0, 0.15))
+
+# Optional codecs are registered if their modules are installed, but only imported once
+# used, like lzma, so shims that never compress don't pay for them.
+
+def zstd_compressor(level):
+    def fn(zdict):
+        import zstandard
+        if zdict:
+            zdict = zstandard.ZstdCompressionDict(zdict)
+        return zstandard.ZstdCompressor(level=level, dict_data=zdict).compressobj()
+    return fn
+
+
+def zstd_decompressor(zdict):
+    import zstandard
+    if zdict:
+        zdict = zstandard.ZstdCompressionDict(zdict)
+    return zstandard.ZstdDecompressor(dict_data=zdict).decompressobj()
+
+
+class Lz4Compressor(object):
+    def __init__(self):
+        import lz4.frame
+        self.c = lz4.frame.LZ4FrameCompressor()
+        self.header = self.c.begin()
+
+    def compress(self, b):
+        (header, self.header) = (self.header, b'')
+        return header + self.c.compress(b)
+
+    def flush(self):
+        (header, self.header) = (self.header, b'')
+        return header + self.c.flush()
+
+
+def lz4_decompressor(zdict):
+    import lz4.frame
+    return lz4.frame.LZ4FrameDecompressor()
+
+
+if importlib.util.find_spec('zstandard'):
+    register_codec(Codec('zstd-1', zstd_compressor(1), zstd_decompressor, 300.0, 0.22, True))
+    register_codec(Codec('zstd-3', zstd_compressor(3), zstd_decompressor, 200.0, 0.19, True))
+    register_codec(Codec('zstd-9', zstd_compressor(9), zstd_decompressor, 50.0, 0.16, True))
+
+if importlib.util.find_spec('lz4'):
+    register_codec(Codec('lz4', lambda zdict: Lz4Compressor(), lz4_decompressor, 500.0, 0.35))
+
+try:
+    CODEC_NAMES = CONFIG['CCERB_CODECS'] # e.g. ['none', 'zlib-1'], to restrict choices.
+except KeyError:
+    CODEC_NAMES = list(CODECS.keys())
+CODEC_NAMES = [x for x in CODEC_NAMES if x in CODECS]
+
+# -
+
+# We pick codecs per-connection to minimize the estimated time per input byte:
+#   1/compress_mbps + ratio/link_mbps
+# Compression rate and ratio are measured on each run, and link bandwidth is measured on
+# each send, per peer. These persist in ~/.pydra, since shims are short-lived.
+
+class LinkStats(object):
+    EWMA_WEIGHT = 0.3
+    MIN_SAMPLE_BYTES = 1000 * 1000 # Smaller sends mostly just measure the socket buffers.
+    DEFAULT_LINK_MBPS = 50.0
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.lock = threading.Lock()
+        self.codecs = None # Read on first use, since most shims never send anything big.
+        self.links = None
+
+
+    def _load(self):
+        assert self.lock.locked()
+        if self.codecs is not None:
+            return
+        (self.codecs, self.links) = ({}, {})
+        try:
+            data = json.loads(self.path.read_text())
+            self.codecs = data['codecs']
+            self.links = data['links']
+        except (OSError, ValueError, KeyError):
+            pass
+
+
+    def save(self):
+        with self.lock:
+            if self.codecs is None:
+                return # Unused, so unchanged.
+            text = json.dumps({'codecs': self.codecs, 'links': self.links})
+        temp_path = temp_path_for(self.path)
+        try:
+            temp_path.write_text(text)
+            os.replace(temp_path, self.path)
+        except OSError:
+            pass
+
+
+    def _ewma(self, old, new):
+        return old + (new - old) * self.EWMA_WEIGHT
+
+
+    def codec_perf(self, name, kind):
+        with self.lock:
+            self._load()
+            try:
+                return tuple(self.codecs[name + '/' + kind])
+            except KeyError:
+                pass
+        (mbps, ratio) = CODECS[name].prior
+        if kind.endswith(DICT_KIND_SUFFIX):
+            ratio *= DICT_PRIOR_RATIO
+        return (mbps, ratio)
+
+
+    def link_mbps(self, peer):
+        with self.lock:
+            self._load()
+            return self.links.get(peer, self.DEFAULT_LINK_MBPS)
+
+
+    def add_sample(self, peer, codec, kind, ct, total_secs):
+        if ct.in_size < self.MIN_SAMPLE_BYTES:
+            return
+        mbps = ct.in_size / 1000 / 1000 / max(ct.secs, 1e-6)
+        ratio = ct.out_size / ct.in_size
+        # If compression was the bottleneck, sends return instantly, and this over-estimates
+        # the link. That's fine: We'll try a faster codec next time, and measure again.
+        link_mbps = ct.out_size / 1000 / 1000 / max(total_secs - ct.secs, 1e-6)
+
+        key = codec.name + '/' + kind
+        with self.lock:
+            self._load()
+            if codec.fn_compressor:
+                (old_mbps, old_ratio) = self.codecs.get(key, codec.prior)
+                self.codecs[key] = (self._ewma(old_mbps, mbps), self._ewma(old_ratio, ratio))
+            old_link = self.links.get(peer, link_mbps)
+            self.links[peer] = self._ewma(old_link, link_mbps)
+
+
+    def choose(self, names, peer, kind, is_local, has_dict=False):
+        if is_local:
+            return CODECS['none']
+        link_mbps = self.link_mbps(peer)
+
+        def est_secs_per_mb(name):
+            (mbps, ratio) = self.codec_perf(name, stats_kind(CODECS[name], kind, has_dict))
+            return 1.0 / mbps + ratio / link_mbps
+
+        names = [x for x in names if x in CODEC_NAMES]
+        best = min(names, key=est_secs_per_mb, default='none')
+        logging.debug('  <codec for %s: %s (link %.1f MB/s)>', peer, best, link_mbps)
+        return CODECS[best]
+
+
+LINK_STATS = LinkStats(PYDRA_HOME / 'ccerb_links.json')
+
+DICT_KIND_SUFFIX = '+dict'
+DICT_PRIOR_RATIO = 0.6
+
+def stats_kind(codec, kind, has_dict):
+    if has_dict and codec.supports_dict:
+        return kind + DICT_KIND_SUFFIX
+    return kind
+
+
+def is_local_peer(pconn):
+    local_addr = pconn.conn.getsockname()
+    remote_addr = pconn.conn.getpeername()
+    return remote_addr[0] == local_addr[0]
+
+# -
+
+# `zdict` is only used if the codec supports it. The receiver must pass the same zdict.
+def send_compressed(pconn, chunks, codec, name, kind, zdict=None):
+    peer = pconn.conn.getpeername()[0]
+    pconn.send(codec.name.encode())
 
-def compress(data, name):
     t = MsTimer()
-    d_size = len(data)
+    ct = ChunkTransform(codec.compress_stages(zdict if codec.supports_dict else None))
+    pconn.send_stream(ct.process(chunks))
+    total_secs = float(t.time()) / 1000.0
+    kind = stats_kind(codec, kind, bool(zdict))
+    LINK_STATS.add_sample(peer, codec, kind, ct, total_secs)
 
-    if COMPRESS_ZLIB_LEVEL:
-        data = zlib.compress(data, level=COMPRESS_ZLIB_LEVEL)
+    if SPEW_COMPRESSION_INFO:
+        d_size = ct.in_size
+        c_size = ct.out_size
+        try:
+            mbps = (d_size / 1000 / 1000) / ct.secs
+        except ZeroDivisionError:
+            mbps = float('Inf')
+        percent = int(c_size / max(d_size, 1) * 100)
+        logging.info('  <compress(%s, %s): %.3f MB/s: %s->%s bytes (%s%%) in %s>', name,
+                codec.name, mbps, d_size, c_size, percent, MsTimer.Res(ct.secs * 1000.0))
 
-    if COMPRESS_LZMA:
-        data = lzma.compress(data)
 
-    c_size = len(data)
+def recv_decompressed(pconn, name, zdict=None):
+    codec = CODECS[pconn.recv().decode()]
+    ct = ChunkTransform(codec.decompress_stages(zdict if codec.supports_dict else None))
+    yield from ct.process(pconn.recv_stream())
 
-    diff = t.time()
-    try:
-        mbps = ((d_size - c_size) / 1000 / 1000) / (float(diff) / 1000)
-    except ZeroDivisionError:
-        mbps = float('Inf')
-    percent = int(c_size / d_size * 100)
     if SPEW_COMPRESSION_INFO:
-        logging.info('  <compress(%s): %.3f Mb/s: %s->%s bytes (%s%%) in %s>'.format(name, mbps, d_size, c_size, percent, diff))
+        c_size = ct.in_size
+        d_size = ct.out_size
+        try:
+            mbps = (d_size / 1000 / 1000) / ct.secs
+        except ZeroDivisionError:
+            mbps = float('Inf')
+        percent = int(c_size / max(d_size, 1) * 100)
+        logging.debug('  <decompress(%s, %s): %.3f MB/s: %s->%s bytes (%s%%) in %s>', name,
+                codec.name, mbps, c_size, d_size, percent, MsTimer.Res(ct.secs * 1000.0))
 
-    return data
 
+def send_codec_names(pconn):
+    for x in CODEC_NAMES:
+        pconn.send(x.encode())
+    pconn.send(b'')
 
-def decompress(data, name=''):
-    t = MsTimer()
-    c_size = len(data)
 
-    if COMPRESS_LZMA:
-        data = lzma.decompress(data)
+def recv_codec_names(pconn):
+    ret = []
+    while True:
+        x = pconn.recv()
+        if not x:
+            return ret
+        ret.append(x.decode())
+
+# -
+
+# Preprocessed TUs share lots of identical header text, so we compress uploads against a
+# dictionary of it. Shims collect samples and periodically retrain; dictionaries are
+# content-addressed, so workers fetch each one from a client at most once.
+
+try:
+    DICT_MAX_BYTES = CONFIG['CCERB_DICT_MAX_BYTES']
+except KeyError:
+    DICT_MAX_BYTES = 110 * 1000 # 0 disables. zlib only uses the last 32KB.
+
+class DictStore(object):
+    SAMPLE_BYTES = 1000 * 1000 # Headers come first, so the start is the useful part.
+    SAMPLE_CHANCE = 1 / 16
+    MAX_SAMPLES = 32
+    MIN_SAMPLES = 8
+    MAX_AGE_SECS = 24 * 60 * 60
+    TRAIN_LOCK_SECS = 10 * 60
+
+    def __init__(self, root, max_bytes):
+        self.root = pathlib.Path(root)
+        self.samples_dir = self.root / 'samples'
+        self.current_path = self.root / 'current'
+        self.max_bytes = max_bytes
+
+
+    def get(self, dict_id):
+        if not dict_id:
+            return None
+        try:
+            return (self.root / dict_id.hex()).read_bytes()
+        except OSError:
+            return None
+
+
+    def put(self, zdict):
+        dict_id = hashlib.sha256(zdict).digest()
+        path = self.root / dict_id.hex()
+        temp_path = temp_path_for(path)
+        try:
+            self.root.mkdir(parents=True, exist_ok=True)
+            temp_path.write_bytes(zdict)
+            os.replace(temp_path, path)
+        except OSError:
+            logging.warning('Failed to write dict: %s', path)
+        return dict_id
+
+
+    def current(self):
+        if not self.max_bytes:
+            return (b'', None)
+        try:
+            dict_id = bytes.fromhex(self.current_path.read_text())
+        except (OSError, ValueError):
+            return (b'', None)
+        zdict = self.get(dict_id)
+        if not zdict:
+            return (b'', None)
+        return (dict_id, zdict)
+
+
+    def add_sample(self, data):
+        if not self.max_bytes or random.random() > self.SAMPLE_CHANCE:
+            return
+        try:
+            self.samples_dir.mkdir(parents=True, exist_ok=True)
+            name = '{}-{}'.format(os.getpid(), time.time())
+            (self.samples_dir / name).write_bytes(data[:self.SAMPLE_BYTES])
+
+            samples = sorted(self.samples_dir.iterdir(), key=lambda x: x.stat().st_mtime)
+            for x in samples[:-self.MAX_SAMPLES]:
+                x.unlink()
+        except OSError:
+            pass
+
+
+    def maybe_train(self):
+        if not self.max_bytes:
+            return
+        try:
+            age = time.time() - self.current_path.stat().st_mtime
+            if age < self.MAX_AGE_SECS:
+                return
+        except OSError:
+            pass
+
+        lock_path = self.root / 'train.lock'
+        try:
+            if time.time() - lock_path.stat().st_mtime > self.TRAIN_LOCK_SECS:
+                lock_path.unlink() # Stale.
+        except OSError:
+            pass
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            return # Someone else is on it.
+        os.close(fd)
+        try:
+            try:
+                samples = [x.read_bytes() for x in self.samples_dir.iterdir()]
+            except OSError:
+                return
+            if len(samples) < self.MIN_SAMPLES:
+                return
+
+            t = MsTimer()
+            zdict = train_dict(samples, self.max_bytes)
+            dict_id = self.put(zdict)
+            temp_path = temp_path_for(self.current_path)
+            temp_path.write_text(dict_id.hex())
+            os.replace(temp_path, self.current_path)
+            logging.info('  <trained dict %s (%i bytes) in %s>', dict_id.hex()[:16],
+                    len(zdict), t.time())
+        except OSError:
+            pass
+        finally:
+            try:
+                lock_path.unlink(missing_ok=True) # Maybe taken as stale meanwhile.
+            except OSError:
+                pass
+
+
+# Raw-content dictionary of the lines shared by the most samples. (Usable by zlib's zdict
+# as well as by zstd.) Most common lines go last, where matches are cheapest to encode.
+def train_dict(samples, max_bytes):
+    counts = collections.Counter()
+    for x in samples:
+        counts.update(set(x.splitlines(keepends=True)))
+
+    lines = []
+    total = 0
+    for (line, n) in counts.most_common():
+        if n < 2:
+            break
+        if total + len(line) > max_bytes:
+            continue
+        lines.append(line)
+        total += len(line)
+    return b''.join(reversed(lines))
+
+
+DICT_STORE = DictStore(PYDRA_HOME / 'ccerb_dicts', DICT_MAX_BYTES)
+
+# -
+
+# Remote preprocessing: Rather than uploading our preprocessed output, ship the source and
+# the headers it includes, and have the worker preprocess in a sandbox that mirrors our
+# paths. Files are content-addressed, and workers keep them on disk, so each one crosses the
+# wire once per worker, and a job's upload is only the bytes that worker hasn't seen.
+# Finding the include set takes a local dependency scan, but only the first time for each TU:
+# After that, the last known set is shipped as is (changed files rehashed, by stat). If a
+# change pulled in a new header, the worker's preprocess fails, and we rescan and resend on
+# the same connection. The compiler's own system dirs are left out of the set, since the
+# worker has those (same cc_key), except for cl's INCLUDE, which is ours, so we map it.
+#
+# Caveat: Headers are matched by resolved path, so a new file shadowing an unchanged include
+# isn't noticed until something else makes the worker's preprocess fail.
+
+try:
+    REMOTE_PREPROC = CONFIG['CCERB_REMOTE_PREPROC']
+except KeyError:
+    REMOTE_PREPROC = False
+
+try:
+    INCLUDE_SETS_MAX_BYTES = CONFIG['CCERB_INCLUDE_SETS_MAX_BYTES']
+except KeyError:
+    INCLUDE_SETS_MAX_BYTES = 1000 * 1000 * 1000
+
+try:
+    BLOB_STORE_MAX_BYTES = CONFIG['CCERB_BLOB_STORE_MAX_BYTES']
+except KeyError:
+    BLOB_STORE_MAX_BYTES = 2 * 1000 * 1000 * 1000 # 0 disables.
+
+
+def is_cl_like(cc_bin):
+    name = os.path.basename(cc_bin).lower()
+    if name.endswith('.exe'):
+        name = name[:-4]
+    return name in ('cl', 'clang-cl')
+
+
+SHOW_INCLUDES_PREFIX = b'Note: including file:'
+
+def scan_includes(cc_bin, preproc_args, source_path):
+    import subprocess
+    if is_cl_like(cc_bin):
+        args = [cc_bin] + preproc_args
+        if '-showIncludes' not in args:
+            args.append('-showIncludes')
+        p = subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if p.returncode != 0:
+            raise ExShimOut('include scan failed', logging.info)
+        paths = [source_path]
+        for line in p.stderr.splitlines():
+            if line.startswith(SHOW_INCLUDES_PREFIX):
+                paths.append(line[len(SHOW_INCLUDES_PREFIX):].strip().decode())
+    else:
+        with ScopedTempDir() as temp_dir:
+            dep_path = os.path.join(temp_dir.path, 'deps')
+            p = subprocess.run([cc_bin] + preproc_args + ['-M', '-MF', dep_path],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            if p.returncode != 0:
+                raise ExShimOut('include scan failed', logging.info)
+            with open(dep_path, 'rb') as f:
+                paths = parse_make_deps(f.read())
+
+    ret = []
+    for x in paths:
+        x = os.path.abspath(x)
+        if x not in ret:
+            ret.append(x)
+    return ret
+
+
+SYSTEM_DIRS_START = b'#include <...> search starts here:'
+SYSTEM_DIRS_END = b'End of search list.'
+FRAMEWORK_DIR_SUFFIX = b' (framework directory)'
+
+# The dirs a cc-like compiler searches without being told to, for C and C++.
+def query_system_dirs(cc_bin):
+    import subprocess
+    dirs = set()
+    for lang in ('c', 'c++'):
+        p = subprocess.run([cc_bin, '-x', lang, '-E', '-v', os.devnull],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        lines = iter(p.stderr.splitlines())
+        for line in lines:
+            if line.startswith(SYSTEM_DIRS_START):
+                break
+        for line in lines:
+            if line.startswith(SYSTEM_DIRS_END):
+                break
+            line = line.strip()
+            if line.endswith(FRAMEWORK_DIR_SUFFIX):
+                line = line[:-len(FRAMEWORK_DIR_SUFFIX)]
+            dirs.add(os.path.abspath(os.fsdecode(line)))
+    return sorted(dirs)
+
+
+def system_dirs(cc_bin, cc_key):
+    if is_cl_like(cc_bin):
+        return [] # Its INCLUDE is the client's, so it's mapped into the sandbox instead.
+    key = cache_hasher(cc_key, ['system dirs', cc_bin]).digest()
+    dirs = INCLUDE_SETS.get(key)
+    if not dirs:
+        dirs = query_system_dirs(cc_bin)
+        INCLUDE_SETS.put(key, dirs)
+    return dirs
+
+
+RE_MAKE_DEP_SPLIT = re.compile(rb'(?<!\\)\s+')
+
+def parse_make_deps(data):
+    # `target: dep dep \
+    #   dep`, and then maybe -MP's phony rules, which we skip.
+    rule = data.replace(b'\\\r\n', b' ').replace(b'\\\n', b' ').splitlines()[0]
+    (_, deps) = rule.split(b': ', 1)
+    return [x.replace(b'\\ ', b' ').decode() for x in RE_MAKE_DEP_SPLIT.split(deps) if x]
+
+
+def quote_make(x):
+    return x.replace('$', '$$').replace('#', '\\#').replace(' ', '\\ ')
+
+
+# A dep file the compiler would have written (-MD/-MMD, or clang-cl's -dependency-file).
+# The worker's sandbox has no dir to write it to, and it wouldn't come back, so we write it
+# from the include set. Like -MMD's, it leaves out the compiler's own headers.
+class DepFile(object):
+    def __init__(self, path, targets, phony):
+        self.path = path
+        self.targets = targets
+        self.phony = phony
+
+
+    # `paths` starts with the source.
+    def write(self, paths):
+        deps = [quote_make(x) for x in paths]
+        text = ' '.join(self.targets) + ':' + ''.join(' \\\n ' + x for x in deps) + '\n'
+        if self.phony: # -MP
+            text += ''.join('\n{}:\n'.format(x) for x in deps[1:])
+        try:
+            pathlib.Path(self.path).write_bytes(os.fsencode(text))
+        except OSError as e:
+            raise ExShimOut('failed to write dep file: {}'.format(e), logging.warning)
+
+
+def output_name(cc_bin, compile_args, source_file_name):
+    if is_cl_like(cc_bin):
+        for x in compile_args:
+            if x.startswith('-Fo'):
+                return x[3:]
+        return os.path.splitext(source_file_name)[0] + '.obj'
+    for (i, x) in enumerate(compile_args):
+        if x == '-o' and i + 1 < len(compile_args):
+            return compile_args[i + 1]
+        if x.startswith('-o') and len(x) > 2:
+            return x[2:]
+    return os.path.splitext(source_file_name)[0] + '.o'
+
+
+# Returns (`cc_args` without dep file args, DepFile or None), for compiling `output`.
+def split_dep_args(cc_bin, cc_args, output):
+    if '-M' in cc_args or '-MM' in cc_args:
+        return (cc_args, None) # Deps instead of preprocessing. Not ours to split.
+    cl_like = is_cl_like(cc_bin)
+
+    args = list(cc_args)
+    ret = []
+    (wanted, path, targets, phony) = (False, None, [], False)
+    while args:
+        cur = args.pop(0)
+        if cl_like:
+            # As extract_cc_preproc_args groups them. (cl's own -MD is its runtime library.)
+            if cur == '-Xclang' and args and args[0] == '-MP':
+                args.pop(0)
+                phony = True
+                continue
+            if cur == '-Xclang' and args and args[0] in ('-dependency-file', '-MT'):
+                (opt, _, val) = args[:3]
+                del args[:3]
+                if opt == '-MT':
+                    targets.append(val)
+                else:
+                    (wanted, path) = (True, val)
+                continue
+        else:
+            if cur in ('-MD', '-MMD'):
+                wanted = True
+                continue
+            if cur == '-MP':
+                phony = True
+                continue
+            if cur[:3] in ('-MF', '-MT', '-MQ'):
+                val = cur[3:]
+                if not val and args:
+                    val = args.pop(0)
+                if cur.startswith('-MF'):
+                    path = val
+                elif cur.startswith('-MQ'):
+                    targets.append(quote_make(val))
+                else:
+                    targets.append(val)
+                continue
+        ret.append(cur)
+
+    if not wanted:
+        return (ret, None)
+    if not path:
+        path = os.path.splitext(output)[0] + '.d'
+    return (ret, DepFile(path, targets or [quote_make(output)], phony))
 
-    if COMPRESS_ZLIB_LEVEL:
-        data = zlib.decompress(data)
 
-    d_size = len(data)
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for x in nu.read_chunks(f):
+            h.update(x)
+    return h.digest()
 
-    diff = t.time()
+
+# {path: [mtime_ns, size, hash_hex]} per (compiler, preproc args, cwd, INCLUDE), and each
+# compiler's system_dirs.
+class IncludeSets(object):
+    def __init__(self, root, max_bytes):
+        self.root = pathlib.Path(root)
+        self.max_bytes = max_bytes
+
+
+    def get(self, key):
+        if not self.max_bytes:
+            return {}
+        path = self.root / key.hex()
+        try:
+            ret = json.loads(path.read_text())
+            os.utime(path)
+            return ret
+        except (OSError, ValueError):
+            return {}
+
+
+    def put(self, key, files):
+        if not self.max_bytes:
+            return
+        path = self.root / key.hex()
+        temp_path = temp_path_for(path)
+        try:
+            self.root.mkdir(parents=True, exist_ok=True)
+            text = json.dumps(files)
+            temp_path.write_text(text)
+            os.replace(temp_path, path)
+        except OSError:
+            logging.warning('Failed to write include set: %s', path)
+            return
+        maybe_evict_lru(self.root, self.max_bytes, len(text))
+
+
+INCLUDE_SETS = IncludeSets(PYDRA_HOME / 'ccerb_includes', INCLUDE_SETS_MAX_BYTES)
+
+
+def is_unchanged(path, rec):
     try:
-        mbps = ((d_size - c_size) / 1000 / 1000) / (float(diff) / 1000)
-    except ZeroDivisionError:
-        mbps = float('Inf')
-    percent = int(c_size / d_size * 100)
-    if SPEW_COMPRESSION_INFO:
-        logging.debug('  <decompress(%s): %.3f Mb/s: %s->%s bytes (%s%%) in %s>'.format(name, mbps, c_size, d_size, percent, diff))
+        st = os.stat(path)
+    except OSError:
+        return False
+    return [st.st_mtime_ns, st.st_size] == rec[:2]
+
+
+class RemoteInputs(object):
+    def __init__(self, cc_bin, cc_key, preproc_args, source_path):
+        self.cc_bin = cc_bin
+        self.cc_key = cc_key
+        self.preproc_args = preproc_args
+        self.source_path = source_path
+        self.cwd = os.getcwd()
+        self.include_env = ''
+        if is_cl_like(cc_bin):
+            self.include_env = os.environ.get('INCLUDE', '')
+        self.lock = threading.Lock()
+
+        self.key = cache_hasher(cc_key, preproc_args + [self.cwd, self.include_env]).digest()
+        old = INCLUDE_SETS.get(self.key)
+        self.scanned = not old # Else unverified until a worker preprocesses with it.
+        if old:
+            self._set_recs(list(old), old)
+        else:
+            self._set_recs(self._scan(), {})
+
+
+    def _scan(self):
+        skipped = tuple(x + os.sep for x in system_dirs(self.cc_bin, self.cc_key))
+        paths = scan_includes(self.cc_bin, self.preproc_args, self.source_path)
+        return [x for x in paths if not x.startswith(skipped)]
+
+
+    def _set_recs(self, paths, old):
+        recs = {}
+        for path in paths:
+            rec = old.get(path)
+            if not rec or not is_unchanged(path, rec):
+                try:
+                    # Stat before hashing, so a write in between just means a rehash later.
+                    st = os.stat(path)
+                    rec = [st.st_mtime_ns, st.st_size, hash_file(path).hex()]
+                except OSError:
+                    continue # Gone. If it's still needed, the worker's preprocess will fail.
+            recs[path] = rec
+        if recs != old:
+            INCLUDE_SETS.put(self.key, recs)
+
+        self.recs = recs
+        self.files = [(path, bytes.fromhex(rec[2])) for (path, rec) in recs.items()]
+        self.total_bytes = sum(rec[1] for rec in recs.values())
+
+
+    # After a worker failed to preprocess with `files`, unless a racing attempt already did.
+    def rescan(self, files):
+        with self.lock:
+            if self.files is files:
+                logging.info('  <remote preproc failed: rescanning includes>')
+                self._set_recs(self._scan(), self.recs)
+                self.scanned = True
+
+
+    # Stands in for cache_digest, since we never see the preprocessed source.
+    def digest(self, cc_key, compile_args):
+        h = cache_hasher(cc_key, compile_args + self.preproc_args + [self.cwd, self.include_env])
+        for (path, file_hash) in sorted(self.files):
+            h.update(path.encode())
+            h.update(file_hash)
+        return h.digest()
+
+
+    def send(self, pconn):
+        worker_codec_names = recv_codec_names(pconn)
+        peer = pconn.conn.getpeername()[0]
+        codec = LINK_STATS.choose(worker_codec_names, peer, 'header', is_local_peer(pconn))
+
+        for x in self.preproc_args:
+            pconn.send(x.encode())
+        pconn.send(b'')
+        pconn.send(self.cwd.encode())
+        pconn.send(self.include_env.encode())
+
+        while True:
+            with self.lock:
+                (files, scanned) = (self.files, self.scanned)
+            pconn.send_t(BOOL_T, scanned)
+            self._send_files(pconn, codec, files)
+
+            if pconn.recv_t(BOOL_T):
+                return pconn.recv() # stdout_prefix
+            if scanned:
+                raise ExShimOut('remote preproc failed', logging.info) # Safer to shim out.
+            self.rescan(files)
+
+
+    def _send_files(self, pconn, codec, files):
+        # The paths are long and repetitive, and there are thousands.
+        bw = ByteWriter()
+        bw.pack_t(U32_T, len(files))
+        for (path, file_hash) in files:
+            bw.pack_bytes(path.encode())
+            bw.pack_bytes(file_hash)
+        send_compressed(pconn, nu.iter_chunks(bw.data()), codec, 'manifest', 'header')
+
+        br = ByteReader(pconn.recv())
+        wanted = set(br.unpack_bytes() for _ in range(br.unpack_t(U32_T)))
+        if not wanted:
+            return
+        blobs = []
+        for (path, file_hash) in files:
+            if file_hash in wanted:
+                wanted.remove(file_hash)
+                try:
+                    with open(path, 'rb') as f:
+                        blobs.append(f.read())
+                except OSError:
+                    blobs.append(b'') # Gone, so the worker sees a mismatch.
 
+        bw = ByteWriter()
+        bw.pack_t(U32_T, len(blobs))
+        for x in blobs:
+            bw.pack_t(U64_T, len(x))
+        pconn.send(bw.data())
+
+        # One stream for all of them, so the codec sees across files.
+        send_compressed(pconn, iter(blobs), codec, 'headers', 'header')
+
+
+# -
+
+# Content-addressed files on disk, named by sha256. Shared by all of a worker's jobs, and
+# kept across restarts. LRU by mtime, like the result caches.
+class BlobStore(object):
+    def __init__(self, root, max_bytes):
+        self.root = pathlib.Path(root)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.bytes_since_evict = 0
+
+
+    def path(self, file_hash):
+        return self.root / file_hash.hex()
+
+
+    # Hardlinks (or copies) a blob to `dest`, so it survives eviction from here on.
+    def link(self, file_hash, dest):
+        if not self.max_bytes:
+            return False
+        path = self.path(file_hash)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        try:
+            os.link(path, dest)
+        except FileNotFoundError:
+            return False
+        except OSError:
+            try:
+                shutil.copyfile(path, dest)
+            except OSError:
+                return False
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return True
+
+
+    def put(self, file_hash, data):
+        if not self.max_bytes:
+            return
+        path = self.path(file_hash)
+        temp_path = temp_path_for(path)
+        try:
+            self.root.mkdir(parents=True, exist_ok=True)
+            temp_path.write_bytes(data)
+            os.replace(temp_path, path)
+        except OSError:
+            logging.warning('Failed to write blob: %s', path)
+            return
+
+        with self.lock:
+            self.bytes_since_evict += len(data)
+            should_evict = self.bytes_since_evict > self.max_bytes * EVICT_EVERY_FRACTION
+            if should_evict:
+                self.bytes_since_evict = 0
+        if should_evict:
+            evict_lru(self.root, self.max_bytes)
+
+
+BLOB_STORE = BlobStore(PYDRA_HOME / 'ccerb_blobs', BLOB_STORE_MAX_BYTES)
+SANDBOX_ROOT = PYDRA_HOME / 'ccerb_sandboxes' # Same filesystem as the blobs, for hardlinks.
+SANDBOX_DIRS = ScratchDirs(SANDBOX_ROOT, CONFIG['WORKERS'])
+
+
+def sandbox_path(root, path):
+    (drive, rest) = os.path.splitdrive(path)
+    parts = [drive.rstrip(':')] if drive else []
+    return os.path.join(root, *parts, rest.lstrip('/\\'))
+
+
+SANDBOXED_ARG_PREFIXES = ('-I', '-FI', '-include', '-isystem', '-iquote', '-imsvc')
+
+def sandbox_arg(root, arg):
+    if os.path.isabs(arg):
+        return sandbox_path(root, arg)
+    for prefix in SANDBOXED_ARG_PREFIXES:
+        rest = arg[len(prefix):]
+        if arg.startswith(prefix) and os.path.isabs(rest):
+            return prefix + sandbox_path(root, rest)
+    return arg
+
+
+# Line markers and __FILE__ spell paths a few ways, depending on the compiler.
+def unsandbox(data, root, paths):
+    drives = set(os.path.splitdrive(x)[0] for x in paths)
+    for drive in drives:
+        sandboxed = sandbox_path(root, drive + os.sep)
+        original = drive + os.sep
+        spellings = set()
+        for (old, new) in (('\\', '\\'), ('\\', '/'), ('\\', '\\\\')):
+            spellings.add((sandboxed.replace(old, new), original.replace(old, new)))
+        for (x, y) in spellings:
+            data = data.replace(os.fsencode(x), os.fsencode(y))
     return data
 
+
+# Links or writes the client's files into the sandbox. Returns their paths, or None if any
+# changed under the client since it hashed them.
+def recv_files(pconn, sandbox_root):
+    br = ByteReader(b''.join(recv_decompressed(pconn, 'manifest')))
+    files = []
+    for _ in range(br.unpack_t(U32_T)):
+        path = br.unpack_bytes().decode()
+        files.append((path, br.unpack_bytes()))
+
+    # Link what we have into place right away, so eviction while we fetch the rest can't bite.
+    paths_by_wanted = collections.OrderedDict()
+    for (path, file_hash) in files:
+        dest = sandbox_path(sandbox_root, path)
+        if file_hash not in paths_by_wanted and BLOB_STORE.link(file_hash, dest):
+            continue
+        paths_by_wanted.setdefault(file_hash, []).append(dest)
+    logging.debug('  <remote preproc: have %i, want %i of %i files>',
+            len(files) - sum(map(len, paths_by_wanted.values())), len(paths_by_wanted),
+            len(files))
+
+    bw = ByteWriter()
+    bw.pack_t(U32_T, len(paths_by_wanted))
+    for x in paths_by_wanted:
+        bw.pack_bytes(x)
+    pconn.send(bw.data())
+
+    ok = True
+    if paths_by_wanted:
+        br = ByteReader(pconn.recv())
+        sizes = [br.unpack_t(U64_T) for _ in range(br.unpack_t(U32_T))]
+        data = b''.join(recv_decompressed(pconn, 'headers'))
+        pos = 0
+        for ((file_hash, dests), size) in zip(paths_by_wanted.items(), sizes):
+            x = data[pos:pos+size]
+            pos += size
+            if hashlib.sha256(x).digest() != file_hash:
+                ok = False # Changed under the client since it hashed it.
+                continue
+            BLOB_STORE.put(file_hash, x)
+            for dest in dests:
+                write_chunks(dest, [x])
+        data = None
+    if not ok:
+        return None
+    return [x for (x, _) in files]
+
+
+# Returns the preprocessed source, or None if the client should shim out.
+def preproc_remotely(pconn, cc_bin, sandbox_root, cancel):
+    send_codec_names(pconn)
+    preproc_args = []
+    while True:
+        x = pconn.recv()
+        if not x:
+            break
+        preproc_args.append(x.decode())
+    cwd = pconn.recv().decode()
+    include_env = pconn.recv().decode()
+
+    sandbox_cwd = sandbox_path(sandbox_root, cwd)
+    os.makedirs(sandbox_cwd, exist_ok=True)
+
+    env = None
+    if include_env:
+        dirs = [sandbox_path(sandbox_root, x) for x in include_env.split(os.pathsep) if x]
+        env = dict(os.environ)
+        env['INCLUDE'] = os.pathsep.join(dirs)
+
+    args = [cc_bin] + [sandbox_arg(sandbox_root, x) for x in preproc_args]
+    while True:
+        # If the client's include set is unverified, it'll send a rescanned one on failure.
+        scanned = pconn.recv_t(BOOL_T)
+        files = recv_files(pconn, sandbox_root)
+        if files is not None:
+            if scanned:
+                cancel.start() # We have all our inputs.
+            (retcode, stdout, stderr, _) = run_compiler(sandbox_cwd, args, env,
+                                                        cancel if scanned else None)
+            if retcode == 0:
+                break
+            logging.info('Remote preproc failed: %s', stderr.decode(errors='replace'))
+        pconn.send_t(BOOL_T, False)
+        if scanned:
+            return None
+
+    paths = files + [cwd]
+    stdout_prefix = b''
+    if '-showIncludes' in preproc_args:
+        stdout_prefix = unsandbox(stderr, sandbox_root, paths)
+    pconn.send_t(BOOL_T, True)
+    pconn.send(stdout_prefix)
+    return unsandbox(stdout, sandbox_root, paths)
+
 # -
 
-def pydra_job_client(pconn, subkey, compile_args, source_file_name, preproc_data_compressed):
+# Speculative dispatch: If a remote compile runs past a percentile of past compile times
+# for similar sizes, race a duplicate on another worker, and take whichever finishes first.
+# This trims the tail from slow workers (throttled, on battery, noisy neighbours), for the
+# cost of some duplicated work.
+
+try:
+    SPECULATE = CONFIG['CCERB_SPECULATE']
+except KeyError:
+    SPECULATE = False
+
+try:
+    SPECULATE_PERCENTILE = CONFIG['CCERB_SPECULATE_PERCENTILE']
+except KeyError:
+    SPECULATE_PERCENTILE = 95
+
+
+# Recent dispatch times, bucketed by half-octaves of input size. These persist in ~/.pydra,
+# like LinkStats.
+class CompileTimes(object):
+    MAX_SAMPLES = 64 # Per bucket.
+    MIN_SAMPLES = 10
+    MIN_DEADLINE_SECS = 1.0 # Shorter isn't worth a duplicate.
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.lock = threading.Lock()
+        self.secs_by_bucket = None # Read on first use, since only SPECULATE uses it.
+
+
+    def _load(self):
+        assert self.lock.locked()
+        if self.secs_by_bucket is not None:
+            return
+        self.secs_by_bucket = {}
+        try:
+            self.secs_by_bucket = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            pass
+
+
+    def save(self):
+        with self.lock:
+            if self.secs_by_bucket is None:
+                return # Unused, so unchanged.
+            text = json.dumps(self.secs_by_bucket)
+        temp_path = temp_path_for(self.path)
+        try:
+            temp_path.write_text(text)
+            os.replace(temp_path, self.path)
+        except OSError:
+            pass
+
+
+    @staticmethod
+    def bucket(size):
+        return str(int(2 * math.log2(max(size, 1))))
+
+
+    def add_sample(self, size, secs):
+        with self.lock:
+            self._load()
+            samples = self.secs_by_bucket.setdefault(self.bucket(size), [])
+            samples.append(secs)
+            del samples[:-self.MAX_SAMPLES]
+        self.save()
+
+
+    # None until we've seen enough of this size.
+    def deadline(self, size):
+        with self.lock:
+            self._load()
+            samples = sorted(self.secs_by_bucket.get(self.bucket(size), []))
+        if len(samples) < self.MIN_SAMPLES:
+            return None
+        i = min(len(samples) * SPECULATE_PERCENTILE // 100, len(samples) - 1)
+        return max(samples[i], self.MIN_DEADLINE_SECS)
+
+
+COMPILE_TIMES = CompileTimes(PYDRA_HOME / 'ccerb_times.json')
+
+# -
+
+def pydra_job_client(pconn, subkey, compile_args, source_file_name, digest, preproc_data,
+                     remote=None):
     client_timer = MsTimer()
     for x in compile_args:
         pconn.send(x.encode())
     pconn.send(b'')
     pconn.send(source_file_name.encode())
-    pconn.send(preproc_data_compressed)
+    if remote:
+        pconn.send(b'') # The worker digests what it preprocesses.
+    else:
+        pconn.send(digest)
+    send_codec_names(pconn)
+    (dict_id, zdict) = DICT_STORE.current()
+    pconn.send(dict_id)
+
+    stdout_prefix = b''
+    if remote:
+        stdout_prefix = remote.send(pconn)
+        wants_source = False
+    else:
+        wants_source = pconn.recv_t(BOOL_T)
+        worker_codec_names = recv_codec_names(pconn)
+        worker_has_dict = pconn.recv_t(BOOL_T)
+    if wants_source:
+        if zdict and not worker_has_dict:
+            pconn.send(zdict)
+
+        peer = pconn.conn.getpeername()[0]
+        codec = LINK_STATS.choose(worker_codec_names, peer, 'preproc', is_local_peer(pconn),
+                                  bool(zdict))
+        chunks = nu.iter_chunks(preproc_data)
+        send_compressed(pconn, chunks, codec, source_file_name, 'preproc', zdict)
 
     # -
 
     compile_time = MsTimer.Res(pconn.recv_t(F64_T))
     retcode = pconn.recv_t(I32_T)
-    stdout = pconn.recv()
+    stdout = stdout_prefix + pconn.recv()
     stderr = pconn.recv()
 
-    use_compression = pconn.recv_t(BOOL_T)
-    logging.info('use_compression: %s', use_compression)
-
     output_files = []
-    while True:
-        name = pconn.recv()
-        if not name:
-            break
-        data = pconn.recv()
-
-        output_files.append( [name.decode(), data] )
-
-    pconn.nuke()
-
-    if use_compression:
-        for n_d in output_files:
-            n_d[1] = decompress(n_d[1], n_d[0])
+    try:
+        while True:
+            name = pconn.recv()
+            if not name:
+                break
+            name = name.decode()
+            temp_path = output_temp_path(name)
+            output_files.append( [name, temp_path] )
+
+            write_chunks(temp_path, recv_decompressed(pconn, name))
+    except:
+        discard_outputs(output_files)
+        raise
+    finally:
+        pconn.nuke()
+    LINK_STATS.save()
 
     return (retcode, stdout, stderr, output_files, client_timer, compile_time)
 
@@ -569,32 +2251,88 @@ def pydra_job_worker(pconn, worker_hostname, subkey):
             break
         compile_args.append(x.decode())
     source_file_name = pconn.recv().decode()
-    preproc_data = pconn.recv()
-
-    input_files = [[source_file_name, preproc_data]]
-
-    for n_d in input_files:
-        n_d[1] = decompress(n_d[1], n_d[0])
-
-    (retcode, stdout, stderr, output_files, compile_time) = run_in_temp_dir(input_files, compile_args)
-
-    pconn.send_t(F64_T, compile_time.val)
-    pconn.send_t(I32_T, retcode)
-    pconn.send(stdout)
-    pconn.send(stderr)
-
-    local_addr = pconn.conn.getsockname()
-    remote_addr = pconn.conn.getpeername()
-    use_compression = remote_addr[0] != local_addr[0]
-    pconn.send_t(BOOL_T, use_compression)
-
-    for (name,data) in output_files:
-        pconn.send(name.encode())
-        if use_compression:
-            data = compress(data, name) # Compress interleaved with sending. (concurrent?)
-        pconn.send(data)
-    pconn.send(b'')
-
+    digest = pconn.recv()
+    client_codec_names = recv_codec_names(pconn)
+    dict_id = pconn.recv()
+    zdict = DICT_STORE.get(dict_id)
+    cancel = CancelWatch(pconn)
+
+    with ScratchDir() as temp_dir:
+        source_path = pathlib.Path(temp_dir.path) / source_file_name
+        if not digest:
+            with ScratchDir(SANDBOX_DIRS) as sandbox_dir:
+                preproc_data = preproc_remotely(pconn, cc_bin, sandbox_dir.path, cancel)
+            if preproc_data is None:
+                logging.warning('Worker for {}: {}: Remote preproc failed.'.format(
+                        worker_hostname, source_file_name))
+                pconn.send_shutdown()
+                return
+            digest = cache_digest(subkey, compile_args[1:], preproc_data)
+            cached = WORKER_CACHE.get(digest)
+            can_cache = True
+            if not cached:
+                source_path.write_bytes(preproc_data)
+            preproc_data = None # Discard.
+        else:
+            cached = WORKER_CACHE.get(digest)
+            pconn.send_t(BOOL_T, not cached)
+            send_codec_names(pconn)
+            pconn.send_t(BOOL_T, bool(zdict))
+
+        if cached:
+            with cached:
+                cached.extract(temp_dir.path)
+            (retcode, stdout, stderr) = (cached.retcode, cached.stdout, cached.stderr)
+            compile_time = MsTimer.Res(0.0)
+            logging.info('Worker for {}: {}: Cache hit.'.format(worker_hostname, source_file_name))
+        else:
+            if not source_path.exists():
+                # Decompress and write while the upload is still in flight.
+                h = cache_hasher(subkey, compile_args[1:])
+                def hashed(chunks):
+                    for x in chunks:
+                        h.update(x)
+                        yield x
+                if dict_id and not zdict:
+                    zdict = pconn.recv()
+                    if hashlib.sha256(zdict).digest() == dict_id:
+                        DICT_STORE.put(zdict)
+
+                chunks = recv_decompressed(pconn, source_file_name, zdict)
+                write_chunks(source_path, hashed(chunks))
+
+                # Don't let a confused client poison the cache for everyone else.
+                can_cache = h.digest() == digest
+                if not can_cache:
+                    logging.warning('Worker for {}: {}: Digest mismatch.'.format(
+                            worker_hostname, source_file_name))
+
+            cancel.start() # We have all our inputs.
+            (retcode, stdout, stderr, compile_time) = run_compiler(temp_dir.path, compile_args,
+                                                                   cancel=cancel)
+            source_path.unlink()
+
+        output_files = list_files(temp_dir.path)
+
+        pconn.send_t(F64_T, compile_time.val)
+        pconn.send_t(I32_T, retcode)
+        pconn.send(stdout)
+        pconn.send(stderr)
+
+        peer = pconn.conn.getpeername()[0]
+        codec = LINK_STATS.choose(client_codec_names, peer, 'output', is_local_peer(pconn))
+
+        for (name,path) in output_files:
+            pconn.send(name.encode())
+            with path.open('rb') as f:
+                # Compress interleaved with sending.
+                send_compressed(pconn, nu.read_chunks(f), codec, name, 'output')
+        pconn.send(b'')
+
+        if not cached and can_cache and retcode == 0:
+            WORKER_CACHE.put(digest, retcode, stdout, stderr, output_files)
+
+    LINK_STATS.save()
     logging.warning('Worker for {}: {}: ({}) Complete.'.format(
             worker_hostname, source_file_name, t.time()))
 
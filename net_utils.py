@@ -3,11 +3,8 @@ assert __name__ != '__main__'
 
 import logging
 import os
-import pathlib
-import platform
 import socket
 import struct
-import subprocess
 import sys
 import threading
 import time
@@ -22,17 +19,62 @@ class ex_recv_n_eof(OSError):
 
 # --
 
+def recv_n_into(conn, view):
+    while view:
+        got = conn.recv_into(view)
+        if not got:
+            raise ex_recv_n_eof()
+        view = view[got:]
+
+
+# No copies, for large payloads.
+def recv_n_view(conn, n):
+    view = memoryview(bytearray(n))
+    recv_n_into(conn, view)
+    return view
+
+
 def recv_n(conn, n):
     ret = bytearray(n)
-    if n:
-        view = memoryview(ret)
-        while view:
-            got = conn.recv_into(view)
-            if not got:
-                raise ex_recv_n_eof()
-            view = view[got:]
+    recv_n_into(conn, memoryview(ret))
     return bytes(ret)
 
+STREAM_CHUNK_SIZE = 0x40000
+
+def iter_chunks(data, chunk_size=STREAM_CHUNK_SIZE):
+    view = memoryview(data)
+    for i in range(0, len(view), chunk_size):
+        yield view[i:i+chunk_size]
+
+
+def read_chunks(f, chunk_size=STREAM_CHUNK_SIZE):
+    while True:
+        b = f.read(chunk_size)
+        if not b:
+            return
+        yield b
+
+# -
+
+# Scatter-gather sendall: One syscall for header and payload, without concatenating them.
+def sendall_v(conn, parts):
+    views = [memoryview(x).cast('B') for x in parts if len(x)]
+    if not hasattr(conn, 'sendmsg'): # Windows
+        if sum(len(x) for x in views) < 0x1000:
+            conn.sendall(b''.join(views))
+            return
+        for x in views:
+            conn.sendall(x)
+        return
+
+    while views:
+        sent = conn.sendmsg(views)
+        while sent:
+            if sent < len(views[0]):
+                views[0] = views[0][sent:]
+                break
+            sent -= len(views.pop(0))
+
 # --
 
 U8_T = struct.Struct('<B')
@@ -202,7 +244,7 @@ class Server(object):
             except OSError:
                 break
 
-            threading.Thread(target=self._th_on_accept, args=(conn, addr)).start()
+            self._on_accepted(conn, addr)
             continue
 
         nuke_socket(s)
@@ -211,6 +253,10 @@ class Server(object):
         return
 
 
+    def _on_accepted(self, conn, addr):
+        threading.Thread(target=self._th_on_accept, args=(conn, addr)).start()
+
+
     def _th_on_accept(self, conn, addr):
         try:
             self.fn_on_accept(conn=conn, addr=addr, *(self.on_accept_args))
@@ -300,17 +346,38 @@ class PacketConn(object):
     KEEP_ALIVE_VAL = 0xff
 
     def send(self, b):
+        self.sendv([b])
+
+
+    def _header(self, b_len):
+        if b_len < self.LONG_LEN_THRESHOLD:
+            return pack_t(U8_T, b_len)
+        return pack_t(U8_T, self.LONG_LEN_THRESHOLD) + pack_t(U64_T, b_len)
+
+
+    # Sends `parts` as one packet.
+    def sendv(self, parts):
+        header = self._header(sum(len(x) for x in parts))
         with self.slock:
-            if len(b) < self.LONG_LEN_THRESHOLD:
-                send_t(self.conn, U8_T, len(b))
-            else:
-                send_t(self.conn, U8_T, self.LONG_LEN_THRESHOLD)
-                send_t(self.conn, U64_T, len(b))
-            if len(b):
-                self.conn.sendall(b)
+            sendall_v(self.conn, [header] + list(parts))
+
+
+    # Sends each of `packets` as its own packet, in one write. For many small packets.
+    def send_batch(self, packets):
+        parts = []
+        for x in packets:
+            parts.append(self._header(len(x)))
+            parts.append(x)
+        with self.slock:
+            self.conn.sendall(b''.join(parts))
 
 
     def recv(self):
+        return bytes(self.recv_view())
+
+
+    # Returns a memoryview rather than bytes, to avoid copying large packets.
+    def recv_view(self):
         try:
             with self.rlock:
                 if self.awaiting_magic:
@@ -329,15 +396,31 @@ class PacketConn(object):
                     if b_len == self.LONG_LEN_THRESHOLD:
                         b_len = recv_t(self.conn, U64_T)
 
-                    b = b''
-                    if b_len:
-                        b = recv_n(self.conn, b_len)
-                    return b
+                    return recv_n_view(self.conn, b_len)
         except OSError:
             self.nuke()
             raise
 
 
+    # Sends each chunk as its own packet, then an empty packet as terminator.
+    # With `chunks` as a generator, the kernel's send buffer lets producing the next chunk
+    # overlap with sending the previous ones, and memory stays bounded by the chunk size.
+    def send_stream(self, chunks):
+        for x in chunks:
+            if len(x):
+                self.send(x)
+        self.send(b'')
+
+
+    # Yields chunks as they arrive, until send_stream's terminator.
+    def recv_stream(self):
+        while True:
+            b = self.recv_view()
+            if not b:
+                return
+            yield b
+
+
     def send_t(self, t, v):
         b = pack_t(t, v)
         self.send(b)
@@ -422,3 +505,332 @@ class PacketConn(object):
                 self.keepalive_thread = None
         self.nuke()
 
+
+# --
+
+# Packet handlers can be written as generators, which receive each packet via `yield`:
+#
+#   def fn_handler(pconn, *args):
+#       hostname = (yield).decode()
+#       ...
+#
+# They can then be driven either by a blocking PacketConn on its own thread, or by an
+# EventLoop, without duplicating any protocol logic.
+
+def drive_packet_handler(pconn, gen):
+    try:
+        gen.send(None)
+        while True:
+            gen.send(pconn.recv())
+    except (StopIteration, OSError):
+        pass
+    finally:
+        gen.close()
+        pconn.nuke()
+
+# --
+
+class EventPacketConn(object):
+    LONG_LEN_THRESHOLD = PacketConn.LONG_LEN_THRESHOLD
+    KEEP_ALIVE_VAL = PacketConn.KEEP_ALIVE_VAL
+
+    # Sending is still blocking (bounded by the socket timeout), and allowed from any thread.
+    send = PacketConn.send
+    sendv = PacketConn.sendv
+    send_batch = PacketConn.send_batch
+    _header = PacketConn._header
+    send_stream = PacketConn.send_stream
+    send_t = PacketConn.send_t
+
+    def __init__(self, loop, conn, fn_handler, args):
+        self.alive = True
+        self.loop = loop
+        self.conn = conn
+        self.slock = threading.RLock()
+        self.magic = PacketConn.MAGIC
+        self.awaiting_magic = True
+        self.rbuf = bytearray()
+        self.last_recv = time.monotonic()
+        self.gen = None
+
+        conn.settimeout(loop.timeout)
+        try:
+            self.send(self.magic)
+        except OSError:
+            nuke_socket(conn)
+            self.alive = False
+            return
+
+        loop.sel.register(conn, loop.EVENT_READ, self)
+        loop.pconns.add(self)
+
+        self.gen = fn_handler(self, *args)
+        self._feed(None)
+
+
+    def nuke(self):
+        # Never close here: We may be on another thread, or inside our own handler.
+        # The loop will notice and clean up.
+        self.alive = False
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.loop._on_nuked(self)
+
+
+    def _feed(self, b):
+        try:
+            self.gen.send(b)
+        except StopIteration:
+            self.nuke()
+        except OSError:
+            self.nuke()
+        except Exception:
+            traceback.print_exc()
+            self.nuke()
+
+
+    def _pop_packet(self):
+        while self.rbuf:
+            b_len = self.rbuf[0]
+            if b_len == self.KEEP_ALIVE_VAL:
+                del self.rbuf[:1]
+                continue
+            header_len = U8_T.size
+            if b_len == self.LONG_LEN_THRESHOLD:
+                header_len += U64_T.size
+                if len(self.rbuf) < header_len:
+                    return None
+                (b_len,) = U64_T.unpack_from(self.rbuf, U8_T.size)
+            end = header_len + b_len
+            if len(self.rbuf) < end:
+                return None
+            b = bytes(self.rbuf[header_len:end])
+            del self.rbuf[:end]
+            return b
+        return None
+
+
+    def _on_readable(self):
+        try:
+            data = self.conn.recv(0x10000)
+        except (BlockingIOError, socket.timeout):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._close()
+            return
+        self.last_recv = time.monotonic()
+        self.rbuf += data
+
+        while self.alive:
+            b = self._pop_packet()
+            if b == None:
+                break
+            if self.awaiting_magic:
+                self.awaiting_magic = False
+                if b != self.magic:
+                    logging.warning('Expected MAGIC {}, was {}'.format(self.magic, b))
+                    self.nuke()
+                    break
+                continue
+            self._feed(b)
+
+
+    def _on_tick(self, now):
+        if self.loop.timeout and now - self.last_recv > self.loop.timeout:
+            self.nuke()
+            return
+        try:
+            with self.slock:
+                send_t(self.conn, U8_T, self.KEEP_ALIVE_VAL)
+        except OSError:
+            self.nuke()
+
+
+    def _close(self):
+        if self not in self.loop.pconns:
+            return
+        self.loop.pconns.remove(self)
+        self.loop.sel.unregister(self.conn)
+        self.alive = False
+        nuke_socket(self.conn)
+        try:
+            self.gen.close()
+        except Exception:
+            traceback.print_exc()
+
+# -
+
+class EventLoop(object):
+    KEEPALIVE_RATIO = 2.5
+
+    # One thread services every connection. Keepalives for all of them are sent from a
+    # single periodic tick, instead of a thread per connection.
+    def __init__(self, timeout=None):
+        import selectors # Only servers need it, so shims don't pay for it.
+        self.EVENT_READ = selectors.EVENT_READ
+        self.timeout = timeout
+        self.sel = selectors.DefaultSelector()
+        self.pconns = set()
+
+        self.lock = threading.Lock()
+        self.pending = []
+        self.nuked = []
+        (self._wake_r, self._wake_w) = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self.sel.register(self._wake_r, self.EVENT_READ, None)
+
+        threading.Thread(target=self._th_loop, daemon=True).start()
+
+
+    def add(self, conn, fn_handler, args=()):
+        with self.lock:
+            self.pending.append((conn, fn_handler, args))
+        self._wake()
+
+
+    def _on_nuked(self, pconn):
+        with self.lock:
+            self.nuked.append(pconn)
+        self._wake()
+
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b'\0')
+        except OSError:
+            pass # Already full, so already awake.
+
+
+    def _th_loop(self):
+        tick = None
+        if self.timeout:
+            tick = self.timeout / self.KEEPALIVE_RATIO
+            next_tick = time.monotonic() + tick
+
+        while True:
+            wait = None
+            if tick:
+                wait = max(0.0, next_tick - time.monotonic())
+            for (sk, _) in self.sel.select(wait):
+                if not sk.data:
+                    try:
+                        while self._wake_r.recv(0x1000):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+                sk.data._on_readable()
+
+            with self.lock:
+                (pending, self.pending) = (self.pending, [])
+                (nuked, self.nuked) = (self.nuked, [])
+            for (conn, fn_handler, args) in pending:
+                EventPacketConn(self, conn, fn_handler, args)
+            for pconn in nuked:
+                pconn._close()
+
+            if tick:
+                now = time.monotonic()
+                if now >= next_tick:
+                    next_tick = now + tick
+                    for pconn in list(self.pconns):
+                        pconn._on_tick(now)
+
+# -
+
+class EventServer(Server):
+    def __init__(self, addrs, target, on_accept_args=(), timeout=None):
+        super().__init__(addrs, target, on_accept_args)
+        self.loop = EventLoop(timeout)
+
+
+    def _on_accepted(self, conn, addr):
+        self.loop.add(conn, self.fn_on_accept, self.on_accept_args)
+
+# --
+
+# Many logical channels over one PacketConn. Each packet is prefixed with MUX_HEADER_T.
+MUX_HEADER_T = struct.Struct('<IB') # (chan_id, op)
+MUX_DATA = 0
+MUX_CLOSE = 1
+
+class MuxChannel(object):
+    def __init__(self, pconn, chan_id):
+        self.alive = True
+        self.pconn = pconn
+        self.chan_id = chan_id
+        self.header = MUX_HEADER_T.pack(chan_id, MUX_DATA)
+        self.gen = None
+
+
+    def send(self, b):
+        if not self.alive:
+            raise ex_recv_n_eof()
+        self.pconn.sendv([self.header, b])
+
+
+    def send_t(self, t, v):
+        self.send(pack_t(t, v))
+
+
+    def nuke(self):
+        if not self.alive:
+            return
+        self.alive = False
+        try:
+            self.pconn.send(MUX_HEADER_T.pack(self.chan_id, MUX_CLOSE))
+        except OSError:
+            pass
+
+
+    def _feed(self, b):
+        try:
+            self.gen.send(b)
+        except StopIteration:
+            self.nuke()
+        except OSError:
+            self.nuke()
+        except Exception:
+            traceback.print_exc()
+            self.nuke()
+
+
+    def _close(self):
+        self.nuke()
+        try:
+            self.gen.close()
+        except Exception:
+            traceback.print_exc()
+
+
+# A packet handler (see drive_packet_handler) which runs fn_handler per channel.
+def mux_packet_handler(pconn, fn_handler, *args):
+    chans = {}
+    try:
+        while True:
+            b = yield
+            (chan_id, op) = MUX_HEADER_T.unpack_from(b)
+            chan = chans.get(chan_id)
+            if op == MUX_CLOSE:
+                if chan:
+                    del chans[chan_id]
+                    chan._close()
+                continue
+
+            if not chan:
+                chan = MuxChannel(pconn, chan_id)
+                chans[chan_id] = chan
+                chan.gen = fn_handler(chan, *args)
+                chan._feed(None)
+            if chan.alive:
+                chan._feed(b[MUX_HEADER_T.size:])
+            # Keep nuked channels until the remote acks with MUX_CLOSE, so we don't
+            # re-open them for packets already in flight.
+    finally:
+        for chan in chans.values():
+            chan._close()
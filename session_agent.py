@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+assert __name__ == '__main__'
+
+from common import *
+import net_utils as nu
+
+import itertools
+
+# Shims connect here over a Unix domain socket, and we forward them to job_server as
+# channels over one long-lived connection, instead of each shim resolving, connecting
+# and handshaking on its own.
+
+LockingLogHandler.install()
+
+chan_id_counter = itertools.count(1)
+
+g_lock = threading.Lock()
+g_session = None
+shims_by_chan_id = {}
+
+# --
+
+def connect_session():
+    timeout = CONFIG['TIMEOUT_CLIENT_TO_SERVER']
+    (addr, conn) = connect_job_server(timeout)
+    if not addr:
+        logging.error('Failed to resolve mDNS job_server.')
+        return None
+    if not conn:
+        logging.error('Failed to connect to server: %s', addr)
+        return None
+
+    session = nu.PacketConn(conn, CONFIG['KEEPALIVE_TIMEOUT'], True)
+    session.send(b'session')
+    logging.warning('Connected to job_server %s.', addr)
+
+    threading.Thread(target=th_session_recv, args=(session,), daemon=True).start()
+    return session
+
+
+def get_session():
+    global g_session
+    with g_lock:
+        if not (g_session and g_session.alive):
+            g_session = connect_session()
+        return g_session
+
+
+def th_session_recv(session):
+    try:
+        while True:
+            b = session.recv_view()
+            (chan_id, op) = nu.MUX_HEADER_T.unpack_from(b)
+            with g_lock:
+                shim = shims_by_chan_id.get(chan_id)
+            if not shim:
+                continue
+            if op == nu.MUX_CLOSE:
+                shim.nuke()
+                continue
+            try:
+                shim.send(b[nu.MUX_HEADER_T.size:])
+            except OSError:
+                shim.nuke()
+    except OSError:
+        pass
+    finally:
+        logging.warning('Disconnected from job_server.')
+        session.nuke()
+        with g_lock:
+            for shim in shims_by_chan_id.values():
+                if shim.session == session:
+                    shim.nuke()
+
+# --
+
+# `session` is connected by the accept loop, so reconnecting never stalls the event loop.
+def on_accept_shim(pconn, session):
+    chan_id = next(chan_id_counter)
+    pconn.session = session
+    # th_session_recv shouldn't block on any one shim. The socket's buffer holds far more
+    # than a shim is ever sent, so one that fills it has stopped reading, and gets dropped.
+    pconn.conn.setblocking(False)
+
+    with g_lock:
+        shims_by_chan_id[chan_id] = pconn
+    try:
+        header = nu.MUX_HEADER_T.pack(chan_id, nu.MUX_DATA)
+        while True:
+            b = yield
+            pconn.session.sendv([header, b])
+    finally:
+        with g_lock:
+            del shims_by_chan_id[chan_id]
+        try:
+            pconn.session.send(nu.MUX_HEADER_T.pack(chan_id, nu.MUX_CLOSE))
+        except OSError:
+            pass
+
+# --
+
+if not hasattr(socket, 'AF_UNIX'):
+    logging.error('session_agent requires socket.AF_UNIX.')
+    exit(1)
+
+path = CONFIG['SESSION_SOCKET_PATH']
+try:
+    os.unlink(path)
+except FileNotFoundError:
+    pass
+s = socket.socket(socket.AF_UNIX)
+s.bind(path)
+s.listen()
+logging.warning('Listening at: %s', path)
+
+loop = nu.EventLoop() # Local, so no keepalives.
+try:
+    while True:
+        (conn, _) = s.accept()
+        session = get_session()
+        if not session:
+            nu.nuke_socket(conn)
+            continue
+        loop.add(conn, on_accept_shim, (session,))
+except KeyboardInterrupt:
+    pass
+finally:
+    nu.nuke_socket(s)
+    os.unlink(path)
+exit(0)
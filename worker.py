@@ -14,28 +14,90 @@ LockingLogHandler.install()
 
 log_conn_counter = itertools.count(1)
 
-def th_on_accept_log(conn, addr):
+# Shims' records are received for every connection on one EventServer thread, and written out
+# in batches by one more, with a single stdout flush per batch. Each connection gets
+# LOG_RATE_LIMIT records/sec (bursting to LOG_BURST_SECS worth), and records past that, or past
+# MAX_PENDING_BYTES while stdout is backed up, are dropped and counted instead.
+class LogAggregator(object):
+    FLUSH_SECS = 0.05
+    MAX_PENDING_BYTES = 4 * 1000 * 1000
+
+    def __init__(self):
+        self.cv = threading.Condition()
+        self.pending = []
+        self.pending_bytes = 0
+        threading.Thread(target=self._th_write, daemon=True).start()
+
+
+    def add(self, text):
+        with self.cv:
+            if self.pending_bytes >= self.MAX_PENDING_BYTES:
+                return False
+            self.pending.append(text)
+            self.pending_bytes += len(text)
+            self.cv.notify()
+        return True
+
+
+    def _th_write(self):
+        while True:
+            with self.cv:
+                self.cv.wait_for(lambda: self.pending)
+            time.sleep(self.FLUSH_SECS) # Let a batch gather.
+            with self.cv:
+                (pending, self.pending) = (self.pending, [])
+                self.pending_bytes = 0
+            pending.append('')
+            with print_lock:
+                sys.stdout.write('\n'.join(pending))
+                sys.stdout.flush()
+
+
+log_aggregator = LogAggregator()
+
+
+def on_accept_log(pconn):
     conn_id = next(log_conn_counter)
-    conn_prefix = ''
-    if CONFIG['LOG_LEVEL'] == logging.DEBUG:
-        conn_prefix = '[log {}] '.format(conn_id)
+    conn_prefix = '[log {}] '.format(conn_id)
     logging.debug(conn_prefix + '<connected>')
 
-    pconn = nu.PacketConn(conn, CONFIG['KEEPALIVE_TIMEOUT'], True)
+    rate = CONFIG['LOG_RATE_LIMIT']
+    burst = rate * CONFIG['LOG_BURST_SECS']
+    tokens = burst
+    last = time.monotonic()
+    dropped = 0
+
+    def report_dropped():
+        return log_aggregator.add(conn_prefix + '<dropped {} records>'.format(dropped))
+
     try:
         while True:
-            text = pconn.recv().decode()
+            b = yield
+            if rate:
+                now = time.monotonic()
+                tokens = min(burst, tokens + (now - last) * rate)
+                last = now
+                if tokens < 1.0:
+                    dropped += 1
+                    continue
+                tokens -= 1.0
+
+            if dropped and report_dropped():
+                dropped = 0
+            text = b.decode(errors='replace')
             text = text.replace('\n', '\n' + ' '*len(conn_prefix))
-            locked_print(conn_prefix, text)
-    except OSError:
-        pass
+            if not log_aggregator.add(conn_prefix + text):
+                dropped += 1
     finally:
+        if dropped:
+            report_dropped()
         logging.debug(conn_prefix + '<disconnected>')
         pconn.nuke()
 
 # --
 
-log_server = nu.Server([CONFIG['LOG_ADDR']], target=th_on_accept_log)
+# No timeout: Shims don't send keepalives, and their sockets close when they exit.
+log_server = nu.EventServer([CONFIG['LOG_ADDR']], target=on_accept_log)
 log_server.listen_until_shutdown()
 
 # ---------------------------
@@ -58,6 +120,7 @@ work_conn_counter = itertools.count(1)
 
 utilization_cv = threading.Condition()
 active_slots = 0
+accepted_jobs = 0
 cpu_load = 0.0
 
 # --
@@ -67,15 +130,18 @@ def th_on_accept_work(conn, addr):
     conn_prefix = worker_prefix + '[worklet {}] '.format(conn_id)
 
     global active_slots
+    global accepted_jobs
 
     try:
-        active_slots += 1
-        if active_slots > CONFIG['WORKERS']:
+        with utilization_cv:
+            active_slots += 1
+            accepted_jobs += 1 # Even if refused: Either way, its slot lease is used up.
+            refused = active_slots > CONFIG['WORKERS']
+            utilization_cv.notify_all()
+        if refused:
             logging.info(conn_prefix + '<refused>')
             return
         logging.debug(conn_prefix + '<connected>')
-        with utilization_cv:
-            utilization_cv.notify_all()
 
         pconn = nu.PacketConn(conn, CONFIG['KEEPALIVE_TIMEOUT'], True)
         hostname = pconn.recv().decode()
@@ -89,9 +155,9 @@ def th_on_accept_work(conn, addr):
     except OSError:
         pass
     finally:
-        active_slots -= 1
         logging.debug(conn_prefix + '<disconnected>')
         with utilization_cv:
+            active_slots -= 1
             utilization_cv.notify_all()
 
 work_server = nu.Server([CONFIG['WORKER_BASE_ADDR']], target=th_on_accept_work)
@@ -133,12 +199,10 @@ def advert_to_server():
         return
 
     timeout = CONFIG['TIMEOUT_WORKER_TO_SERVER']
-    addr = job_server_addr(timeout)
+    (addr, conn) = connect_job_server(timeout)
     if not addr:
         logging.warning(worker_prefix + 'No mDNS response from job_server.')
         return
-
-    conn = nu.connect_any([addr[:2]], timeout=timeout)
     if not conn:
         logging.error(worker_prefix + 'Failed to connect: {}'.format(addr))
         return
@@ -188,7 +252,11 @@ def advert_to_server():
                 avail_slots = min(avail_slots, cpu_idle)
                 if avail_slots > max_slots - 1:
                     avail_slots = max_slots
-                pconn.send_t(F64_T, avail_slots)
+
+                report = SlotReport()
+                report.avail_slots = avail_slots
+                report.accepted = accepted_jobs
+                pconn.send(report.encode())
 
                 utilization_cv.wait(10.0) # Refresh, just slowly if not notified.
                 time.sleep(0.1) # Minimum delay between updates